@@ -1,3 +1,15 @@
+import itertools
+import os
+import pickle
+import queue
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+
 class Receiver:
     """the receiver classes can contain the bussiness logic of the application"""
     def __init__(self) -> None:
@@ -15,6 +27,21 @@ class BaseCommand:
     def execute_request(self):
         raise NotImplementedError("Not implemented")
 
+    def batch_key(self) -> Optional[Hashable]:
+        """commands with the same key can be executed together by execute_batch,
+        None means the command can not be batched"""
+        return None
+
+    @classmethod
+    def execute_batch(cls, commands: List["BaseCommand"]):
+        for command in commands:
+            command.execute_request()
+
+    def compact_key(self) -> Optional[Hashable]:
+        """when the journal is compacted, only the last command of each key is
+        kept, None means the command is always kept"""
+        return None
+
 
 class SimpleCommand(BaseCommand):
     """This command contain the bussiness logic internally"""
@@ -31,12 +58,421 @@ class CommandWithReceiver(BaseCommand):
         print("Delegating bussiness logic to a receiver")
         self._receiver.execute_action()
 
+    def batch_key(self) -> Optional[Hashable]:
+        return (type(self), id(self._receiver))
+
+    @classmethod
+    def execute_batch(cls, commands: List["CommandWithReceiver"]):
+        # subclasses with their own logic run it command by command
+        if cls.execute_request is not CommandWithReceiver.execute_request:
+            super().execute_batch(commands)
+            return
+
+        # all the commands of a batch share the same class and receiver
+        print(f"Delegating {len(commands)} requests to a receiver")
+        receiver = commands[0]._receiver
+        for _ in commands:
+            receiver.execute_action()
+
+
+class CommandBus:
+    """Executes the commands on a pool of worker threads. The commands wait in a
+    bounded queue (submit blocks when it is full) ordered by priority, lower
+    values first. A worker takes up to `max_batch` commands at once and runs the
+    ones with the same batch_key together"""
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+    def __init__(
+        self, workers: int = 4, max_queue: int = 10_000, max_batch: int = 64
+    ) -> None:
+        self.max_batch = max_batch
+        self._queue: queue.PriorityQueue = queue.PriorityQueue(max_queue)
+        # keeps the submit order inside a priority
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+        self.submitted = 0
+        self.executed = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self._workers = [
+            threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(
+        self, command: BaseCommand, priority: int = NORMAL, timeout: float = None
+    ):
+        entry = (priority, next(self._sequence), time.perf_counter(), command)
+        self._queue.put(entry, timeout=timeout)
+        with self._lock:
+            self.submitted += 1
+
+    def _take_batch(self) -> list:
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch and batch[-1][3] is not None:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                stop = self._run_batch(batch)
+            finally:
+                # join() must not wait for the entries of a failed batch
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    # runs the commands of a batch, returns True when it holds a stop marker
+    def _run_batch(self, batch: List[tuple]) -> bool:
+        groups: Dict[Hashable, List[tuple]] = {}
+        stop = False
+        for entry in batch:
+            command = entry[3]
+            if command is None:
+                stop = True
+                continue
+            try:
+                # the commands without a key are executed alone
+                key = command.batch_key()
+                if key is None:
+                    key = object()
+                groups.setdefault(key, []).append(entry)
+            except Exception as error:
+                self._fail([entry], error)
+
+        for entries in groups.values():
+            commands = [entry[3] for entry in entries]
+            try:
+                type(commands[0]).execute_batch(commands)
+            except Exception as error:
+                self._fail(entries, error)
+            else:
+                self._record(entries, 0)
+        return stop
+
+    def _fail(self, entries: List[tuple], error: Exception):
+        self._record(entries, len(entries))
+        try:
+            print(f"Command {entries[0][3].__class__.__name__} failed: {error!r}")
+        except Exception:
+            # a broken repr must not kill the worker
+            print(f"Command {entries[0][3].__class__.__name__} failed")
+
+    def _record(self, entries: List[tuple], failed: int):
+        now = time.perf_counter()
+        latencies = [now - entry[2] for entry in entries]
+        with self._lock:
+            self.executed += len(entries)
+            self.errors += failed
+            self.total_latency += sum(latencies)
+            self.max_latency = max(self.max_latency, *latencies)
+
+    def join(self):
+        """waits until all the submitted commands were executed"""
+        self._queue.join()
+
+    def shutdown(self):
+        self.join()
+        # the stop markers go after every other command
+        for _ in self._workers:
+            self._queue.put((float("inf"), next(self._sequence), 0.0, None))
+        for worker in self._workers:
+            worker.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = time.perf_counter() - self._started_at
+            executed = self.executed
+            return {
+                "submitted": self.submitted,
+                "executed": self.executed,
+                "errors": self.errors,
+                "average_latency": self.total_latency / executed if executed else 0.0,
+                "max_latency": self.max_latency,
+                "throughput": self.executed / elapsed if elapsed else 0.0,
+            }
+
+
+class CommandJournal:
+    """A write-ahead journal of pickled commands. The records are length
+    prefixed and appended to a file. The fsync is shared by all the commands
+    appended in the same `group_interval` (group commit): `append` waits until
+    its record is durable, but many appends cost a single fsync. Every
+    `compact_every` appended records, the journal is rewritten keeping only the
+    last command of each compact_key, so the replay time stays bounded. If the
+    fsync or a compaction of the flusher fails, the error is raised to every
+    waiting and later append"""
+
+    _header = struct.Struct("<I")
+
+    def __init__(
+        self,
+        path: str,
+        group_interval: float = 0.005,
+        compact_every: Optional[int] = 100_000,
+    ) -> None:
+        self.path = path
+        self.group_interval = group_interval
+        self.compact_every = compact_every
+        self.syncs = 0
+        records, valid_size = self._scan()
+        self._records = len(records)
+        # records appended since the last compaction, the existing ones count too
+        self._uncompacted = len(records)
+        self._file = open(path, "ab")
+        self._file.truncate(valid_size)
+        self._condition = threading.Condition()
+        self._written = 0
+        self._synced = 0
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        # only one compaction at a time, the appends do not wait for it
+        self._compaction_lock = threading.Lock()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def append(self, command: BaseCommand, wait: bool = True):
+        data = pickle.dumps(command, pickle.HIGHEST_PROTOCOL)
+        with self._condition:
+            self._raise_error()
+            self._file.write(self._header.pack(len(data)))
+            self._file.write(data)
+            self._written += 1
+            self._records += 1
+            self._uncompacted += 1
+            sequence = self._written
+            self._condition.notify_all()
+            if wait:
+                self._wait_synced(sequence)
+
+    # must be called with the condition held
+    def _wait_synced(self, sequence: int):
+        self._condition.wait_for(
+            lambda: self._synced >= sequence or self._closed or self._error is not None
+        )
+        if self._synced < sequence:
+            self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def _flush_loop(self):
+        try:
+            self._flush_groups()
+        except BaseException as error:
+            # the waiters would never be woken up, they get the error instead
+            with self._condition:
+                self._error = error
+                self._condition.notify_all()
+
+    def _flush_groups(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._written > self._synced or self._closed
+                )
+                if self._closed:
+                    return
+            # let the other appends of the group arrive
+            time.sleep(self.group_interval)
+
+            with self._condition:
+                sequence = self._written
+                self._file.flush()
+                # a compaction may replace the file while the fsync runs unlocked,
+                # the duplicated descriptor stays valid
+                descriptor = os.dup(self._file.fileno())
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+
+            with self._condition:
+                self._synced = sequence
+                self.syncs += 1
+                self._condition.notify_all()
+                compact = (
+                    self.compact_every is not None
+                    and self._uncompacted >= self.compact_every
+                )
+            if compact:
+                self.compact()
+
+    def _scan(self, size: int = -1) -> Tuple[List[memoryview], int]:
+        """the records in the first `size` bytes of the journal (all of them by
+        default) and the size of their valid part"""
+        if not os.path.exists(self.path):
+            return [], 0
+        with open(self.path, "rb") as journal:
+            view = memoryview(journal.read(size))
+
+        records = []
+        offset = 0
+        while offset + self._header.size <= len(view):
+            (size,) = self._header.unpack_from(view, offset)
+            end = offset + self._header.size + size
+            # a record without its full body was cut by a crash
+            if end > len(view):
+                break
+            records.append(view[offset + self._header.size:end])
+            offset = end
+        return records, offset
+
+    def _read_records(self) -> Iterator[memoryview]:
+        return iter(self._scan()[0])
+
+    def commands(self) -> Iterator[BaseCommand]:
+        for record in self._read_records():
+            yield pickle.loads(record)
+
+    def replay(self, execute: Callable[[BaseCommand], None] = None) -> int:
+        """executes again all the journaled commands, for example at startup"""
+        replayed = 0
+        for command in self.commands():
+            if execute is None:
+                command.execute_request()
+            else:
+                execute(command)
+            replayed += 1
+        return replayed
+
+    def compact(self):
+        with self._compaction_lock:
+            with self._condition:
+                # the records still in the write buffer must be part of the new journal
+                self._file.flush()
+                size = self._file.tell()
+                records = self._records
+            self._compact(size, records)
+
+    # rewrites the first `size` bytes (`records` records) without holding the
+    # condition, only the records appended meanwhile are copied under it
+    def _compact(self, size: int, records: int):
+        latest: Dict[Hashable, int] = {}
+        entries = []
+        for index, record in enumerate(self._scan(size)[0]):
+            key = pickle.loads(record).compact_key()
+            if key is not None:
+                latest[key] = index
+            entries.append((key, record))
+
+        # the new journal replaces the old one atomically
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".")
+        try:
+            with os.fdopen(descriptor, "wb") as compacted:
+                kept = 0
+                for index, (key, record) in enumerate(entries):
+                    if key is None or latest[key] == index:
+                        compacted.write(self._header.pack(len(record)))
+                        compacted.write(record)
+                        kept += 1
+                compacted.flush()
+                os.fsync(compacted.fileno())
+
+                with self._condition:
+                    self._file.flush()
+                    with open(self.path, "rb") as journal:
+                        journal.seek(size)
+                        shutil.copyfileobj(journal, compacted)
+                    compacted.flush()
+                    os.fsync(compacted.fileno())
+                    os.replace(temporary_path, self.path)
+                    self._file.close()
+                    self._file = open(self.path, "ab")
+                    appended = self._records - records
+                    self._records = kept + appended
+                    self._uncompacted = appended
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    def sync(self):
+        """waits until every appended command is durable"""
+        with self._condition:
+            self._wait_synced(self._written)
+
+    def close(self):
+        try:
+            self.sync()
+        finally:
+            with self._condition:
+                self._closed = True
+                self._condition.notify_all()
+            self._flusher.join()
+            self._file.close()
+
 
 class Invoker:
     """The invoker is a class that makes requests to command objects"""
+    def __init__(
+        self, bus: Optional[CommandBus] = None, journal: Optional[CommandJournal] = None
+    ) -> None:
+        self._bus = bus
+        self._journal = journal
+
     # example of usage
     def set_callback_command(self, cmd: BaseCommand):
         self._callback_command = cmd
     
     def on_callback(self):
+        # the command is recorded before it runs, so it can be replayed after a crash
+        if self._journal is not None:
+            self._journal.append(self._callback_command)
+        # with a bus, the command runs later on a worker
+        if self._bus is not None:
+            self._bus.submit(self._callback_command)
+            return
         self._callback_command.execute_request()
+
+
+if __name__ == "__main__":
+    invoker = Invoker()
+    invoker.set_callback_command(SimpleCommand())
+    invoker.on_callback()
+
+    # thousands of commands on a bus, the ones with the same receiver run together
+    bus = CommandBus(workers=2)
+    receiver = Receiver()
+    for index in range(5_000):
+        bus.submit(CommandWithReceiver(receiver))
+    bus.submit(SimpleCommand(), priority=CommandBus.HIGH)
+
+    buffered_invoker = Invoker(bus)
+    buffered_invoker.set_callback_command(SimpleCommand())
+    buffered_invoker.on_callback()
+
+    bus.shutdown()
+    print(bus.stats())
+
+    # the journaled commands can be replayed after a restart
+    journal_path = os.path.join(tempfile.mkdtemp(), "commands.journal")
+    journal = CommandJournal(journal_path)
+    journaled_invoker = Invoker(journal=journal)
+    journaled_invoker.set_callback_command(CommandWithReceiver(Receiver()))
+    appenders = [
+        threading.Thread(target=journaled_invoker.on_callback) for _ in range(50)
+    ]
+    for appender in appenders:
+        appender.start()
+    for appender in appenders:
+        appender.join()
+    journal.close()
+    print(f"Journal synced {journal.syncs} times for 50 commands")
+
+    recovered = CommandJournal(journal_path)
+    print(f"Replayed {recovered.replay(lambda command: None)} commands")
+    recovered.close()
@@ -1,5 +1,7 @@
 from __future__ import annotations
-from typing import Dict
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, List, Set, Tuple
 
 
 class BaseComponent:
@@ -27,29 +29,121 @@ class SendButton(BaseComponent):
         self.mediator.notify(self, "on_send")
 
 
-class UploadWindowDialog(BaseMediator):
-    def __init__(self, close_button: BaseComponent, send_button: BaseComponent) -> None:
+# marks a mediator method as a handler of the given events. A coalesced event is
+# delivered once, even if it was notified many times before the queue is flushed
+def handles(*events: str, coalesce: bool = False):
+    def decorator(method: Callable) -> Callable:
+        method._handles = getattr(method, "_handles", ()) + events
+        method._coalesce = coalesce
+        return method
+
+    return decorator
+
+
+class EventMediator(BaseMediator):
+    """A mediator whose handler table is built once per class, from the methods
+    decorated with `handles`. The events are delivered right away ("sync"), kept
+    in a queue until `flush` is called ("queued"), or flushed by the running
+    asyncio loop ("async")"""
+
+    # event -> names of the handler methods
+    _handler_names: Dict[str, Tuple[str, ...]] = {}
+    _coalesced_events: frozenset = frozenset()
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        handler_names: Dict[str, Tuple[str, ...]] = dict(cls._handler_names)
+        coalesced: Set[str] = set(cls._coalesced_events)
+        for name, method in vars(cls).items():
+            for event in getattr(method, "_handles", ()):
+                # an overridden handler decorated again is still called once
+                if name not in handler_names.get(event, ()):
+                    handler_names[event] = handler_names.get(event, ()) + (name,)
+                if method._coalesce:
+                    coalesced.add(event)
+        cls._handler_names = handler_names
+        cls._coalesced_events = frozenset(coalesced)
+
+    def __init__(self, *components: BaseComponent, delivery: str = "sync") -> None:
+        if delivery not in ("sync", "queued", "async"):
+            raise ValueError("Invalid delivery mode provided")
+
+        self.delivery = delivery
+        self.components: List[BaseComponent] = []
+        self._queue: Deque[Tuple[BaseComponent, str]] = deque()
+        self._pending: Set[Tuple[int, str]] = set()
+        self._flush_scheduled = False
+        # the bound methods are created once, not on every event
+        self._handlers: Dict[str, Tuple[Callable, ...]] = {
+            event: tuple(getattr(self, name) for name in names)
+            for event, names in self._handler_names.items()
+        }
+        self.register(*components)
+
+    def register(self, *components: BaseComponent):
+        for component in components:
+            component.mediator = self
+            self.components.append(component)
+
+    def notify(self, sender: BaseComponent, event: str):
+        if self.delivery == "sync":
+            self._deliver(sender, event)
+            return
+
+        if event in self._coalesced_events:
+            key = (id(sender), event)
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._queue.append((sender, event))
+
+        if self.delivery == "async" and not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def _deliver(self, sender: BaseComponent, event: str):
+        for handler in self._handlers.get(event, ()):
+            handler(sender)
+
+    def flush(self) -> int:
+        """delivers the queued events, returns how many were delivered"""
+        self._flush_scheduled = False
+        delivered = 0
+        while self._queue:
+            sender, event = self._queue.popleft()
+            # a coalesced event notified again from now on is queued again
+            self._pending.discard((id(sender), event))
+            self._deliver(sender, event)
+            delivered += 1
+        return delivered
+
+
+class UploadWindowDialog(EventMediator):
+    def __init__(
+        self,
+        close_button: BaseComponent,
+        send_button: BaseComponent,
+        delivery: str = "sync",
+    ) -> None:
         self._close_button = close_button
         self._send_button = send_button
-        self._close_button.mediator = self
-        self._send_button.mediator = self
+        super().__init__(close_button, send_button, delivery=delivery)
 
-    def on_close(self):
+    @handles("on_close")
+    def on_close(self, sender: BaseComponent = None):
         print("Closing window...")
 
-    def on_send(self):
+    @handles("on_send", coalesce=True)
+    def on_send(self, sender: BaseComponent = None):
         print("Uploading files...")
 
-    def notify(self, sender: BaseComponent, event: str):
-        callbacks: Dict[str, function] = {
-            "on_close": self.on_close,
-            "on_send": self.on_send,
-        }
-
-        print(f"Event received: '{sender}' - '{event}'")
 
-        if event in callbacks.keys():
-            callbacks[event]()
+async def run_async_example():
+    send_button = SendButton()
+    dialog = UploadWindowDialog(CloseButton(), send_button, delivery="async")
+    send_button.execute()
+    # delivered by the loop on its next iteration
+    await asyncio.sleep(0)
 
 
 if __name__ == "__main__":
@@ -60,3 +154,12 @@ if __name__ == "__main__":
 
     close_button.execute()
     send_button.execute()
+
+    # many clicks on send before the queue is flushed upload the files only once
+    queued_dialog = UploadWindowDialog(close_button, send_button, delivery="queued")
+    for _ in range(10_000):
+        send_button.execute()
+    close_button.execute()
+    print(f"Delivered {queued_dialog.flush()} events")
+
+    asyncio.run(run_async_example())
@@ -1,5 +1,11 @@
 from __future__ import annotations
-from typing import Any, List
+import copy
+import os
+import pickle
+import tempfile
+import zlib
+from collections import deque
+from typing import Any, Deque, Iterable, Iterator, List, Optional, Tuple
 
 
 class Memento:
@@ -48,3 +54,640 @@ class CareTaker:
     def undo_snapshot(self) -> Memento:
         memento = self._history.pop()
         return memento
+
+
+# persistent (immutable) data structures: every change returns a new object that
+# shares everything but the changed path with the old one. A state made of them can
+# be saved in O(1), because nobody can change the snapshot afterwards
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+
+
+class PersistentVector:
+    """A 32-way trie of the items, `set` and `append` copy only one path"""
+
+    __slots__ = ("_size", "_shift", "_root")
+
+    def __init__(self, items: Iterable[Any] = ()) -> None:
+        self._size = 0
+        self._shift = _BITS
+        self._root: list = []
+        vector = self
+        for item in items:
+            vector = vector.append(item)
+        self._size, self._shift, self._root = vector._size, vector._shift, vector._root
+
+    @classmethod
+    def _make(cls, size: int, shift: int, root: list) -> PersistentVector:
+        vector = cls.__new__(cls)
+        vector._size, vector._shift, vector._root = size, shift, root
+        return vector
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: int) -> Any:
+        if index < 0:
+            index += self._size
+        if not 0 <= index < self._size:
+            raise IndexError("vector index out of range")
+
+        node = self._root
+        for shift in range(self._shift, 0, -_BITS):
+            node = node[(index >> shift) & _MASK]
+        return node[index & _MASK]
+
+    def __iter__(self) -> Iterator[Any]:
+        for index in range(self._size):
+            yield self[index]
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (PersistentVector, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"PersistentVector({list(self)!r})"
+
+    def set(self, index: int, value: Any) -> PersistentVector:
+        if index < 0:
+            index += self._size
+        if index == self._size:
+            return self.append(value)
+        if not 0 <= index < self._size:
+            raise IndexError("vector index out of range")
+
+        root = list(self._root)
+        node = root
+        for shift in range(self._shift, 0, -_BITS):
+            position = (index >> shift) & _MASK
+            node[position] = list(node[position])
+            node = node[position]
+        node[index & _MASK] = value
+        return self._make(self._size, self._shift, root)
+
+    def append(self, value: Any) -> PersistentVector:
+        index = self._size
+        shift = self._shift
+        root = self._root
+        # the trie is full, add a level on top
+        if index == _WIDTH << shift:
+            root = [root]
+            shift += _BITS
+
+        root = list(root)
+        node = root
+        for level in range(shift, 0, -_BITS):
+            position = (index >> level) & _MASK
+            child = list(node[position]) if position < len(node) else []
+            if position < len(node):
+                node[position] = child
+            else:
+                node.append(child)
+            node = child
+        node.append(value)
+        return self._make(index + 1, shift, root)
+
+
+class _Collision:
+    """Keys with the same hash, only used when all the hash bits are consumed"""
+
+    __slots__ = ("items",)
+
+    def __init__(self, items: tuple) -> None:
+        self.items = items
+
+
+class PersistentMap:
+    """A hash array mapped trie, `set` and `delete` copy only one path"""
+
+    __slots__ = ("_size", "_root")
+
+    _max_depth = 64 // _BITS
+
+    def __init__(self, items: Any = ()) -> None:
+        self._size = 0
+        self._root: Optional[list] = None
+        result = self
+        for key, value in dict(items).items():
+            result = result.set(key, value)
+        self._size, self._root = result._size, result._root
+
+    @classmethod
+    def _make(cls, size: int, root: Optional[list]) -> PersistentMap:
+        new_map = cls.__new__(cls)
+        new_map._size, new_map._root = size, root
+        return new_map
+
+    @staticmethod
+    def _hash(key: Any) -> int:
+        return hash(key) & 0xFFFFFFFFFFFFFFFF
+
+    def __len__(self) -> int:
+        return self._size
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        key_hash = self._hash(key)
+        node = self._root
+        depth = 0
+        while True:
+            if node is None:
+                return default
+            if isinstance(node, _Collision):
+                for item_key, item_value in node.items:
+                    if item_key == key:
+                        return item_value
+                return default
+            if isinstance(node, tuple):
+                return node[1] if node[0] == key else default
+            node = node[(key_hash >> (depth * _BITS)) & _MASK]
+            depth += 1
+
+    def __getitem__(self, key: Any) -> Any:
+        value = self.get(key, _NOT_FOUND)
+        if value is _NOT_FOUND:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, _NOT_FOUND) is not _NOT_FOUND
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:
+        return self._node_items(self._root)
+
+    @staticmethod
+    def _node_items(node: Any) -> Iterator[Tuple[Any, Any]]:
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                yield node
+            elif isinstance(node, _Collision):
+                yield from node.items
+            else:
+                stack.extend(child for child in node if child is not None)
+
+    def keys(self) -> Iterator[Any]:
+        return (key for key, _ in self.items())
+
+    def values(self) -> Iterator[Any]:
+        return (value for _, value in self.items())
+
+    def __iter__(self) -> Iterator[Any]:
+        return self.keys()
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (PersistentMap, dict)):
+            return len(self) == len(other) and all(
+                key in other and other[key] == value for key, value in self.items()
+            )
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"PersistentMap({dict(self.items())!r})"
+
+    def set(self, key: Any, value: Any) -> PersistentMap:
+        added = [False]
+        root = self._set(self._root, 0, self._hash(key), key, value, added)
+        return self._make(self._size + added[0], root)
+
+    def _set(self, node: Any, depth: int, key_hash: int, key: Any, value: Any, added: list):
+        if node is None:
+            added[0] = True
+            return (key, value)
+
+        if isinstance(node, tuple):
+            if node[0] == key:
+                return (key, value)
+            if depth > self._max_depth:
+                added[0] = True
+                return _Collision((node, (key, value)))
+            # split the leaf into a branch holding both keys
+            branch: Any = [None] * _WIDTH
+            branch[(self._hash(node[0]) >> (depth * _BITS)) & _MASK] = node
+            return self._set(branch, depth, key_hash, key, value, added)
+
+        if isinstance(node, _Collision):
+            items = tuple(item for item in node.items if item[0] != key)
+            added[0] = len(items) == len(node.items)
+            return _Collision(items + ((key, value),))
+
+        position = (key_hash >> (depth * _BITS)) & _MASK
+        branch = list(node)
+        branch[position] = self._set(node[position], depth + 1, key_hash, key, value, added)
+        return branch
+
+    def delete(self, key: Any) -> PersistentMap:
+        if key not in self:
+            raise KeyError(key)
+        return self._make(self._size - 1, self._delete(self._root, 0, self._hash(key), key))
+
+    def _delete(self, node: Any, depth: int, key_hash: int, key: Any) -> Any:
+        if isinstance(node, tuple):
+            return None
+        if isinstance(node, _Collision):
+            items = tuple(item for item in node.items if item[0] != key)
+            return items[0] if len(items) == 1 else _Collision(items)
+
+        position = (key_hash >> (depth * _BITS)) & _MASK
+        branch = list(node)
+        branch[position] = self._delete(node[position], depth + 1, key_hash, key)
+        children = [child for child in branch if child is not None]
+        # collapse branches that only hold one leaf
+        if not children:
+            return None
+        if len(children) == 1 and not isinstance(children[0], list):
+            return children[0]
+        return branch
+
+
+_NOT_FOUND = object()
+
+
+# converts nested dicts and lists to persistent structures, and back
+def freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return PersistentMap({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return PersistentVector(freeze(item) for item in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    if isinstance(value, PersistentMap):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, PersistentVector):
+        return [thaw(item) for item in value]
+    return value
+
+
+# a patch describes how to turn one state into another:
+#   ("replace", value)                     the whole value changed
+#   ("dict", {key: patch}, [removed keys]) some keys of a dict changed
+#   ("splice", start, stop, [items])       a slice of a list changed
+#   ("map", {key: patch}, [removed keys])  some keys of a PersistentMap changed
+#   ("vector", {index: patch})             some items of a PersistentVector changed
+def diff(old: Any, new: Any) -> Optional[tuple]:
+    if old is new:
+        return None
+
+    # the persistent structures are walked in parallel, the subtrees they share
+    # are skipped, so the cost follows the size of the edit
+    if type(old) is PersistentMap and type(new) is PersistentMap:
+        changed = {}
+        removed = []
+        _diff_map_nodes(old._root, new._root, changed, removed)
+        return ("map", changed, removed) if changed or removed else None
+
+    # a shorter vector can only be built from scratch, nothing is shared
+    if (
+        type(old) is PersistentVector
+        and type(new) is PersistentVector
+        and len(old) <= len(new)
+    ):
+        old_root, shift = old._root, old._shift
+        # the trie grew, the old root is now the first child of the new one
+        while shift < new._shift:
+            old_root, shift = [old_root], shift + _BITS
+        changed = {}
+        _diff_vector_nodes(old_root, new._root, new._shift, 0, changed)
+        return ("vector", changed) if changed else None
+
+    if type(old) is dict and type(new) is dict:
+        changed = {}
+        for key, value in new.items():
+            if key not in old:
+                changed[key] = ("replace", value)
+                continue
+            patch = diff(old[key], value)
+            if patch is not None:
+                changed[key] = patch
+        removed = [key for key in old if key not in new]
+        return ("dict", changed, removed) if changed or removed else None
+
+    if type(old) is list and type(new) is list:
+        # trim the common prefix and suffix, keep only the changed middle
+        start = 0
+        limit = min(len(old), len(new))
+        while start < limit and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < limit - start and old[-1 - end] == new[-1 - end]:
+            end += 1
+        if start == len(old) == len(new):
+            return None
+        return ("splice", start, len(old) - end, new[start:len(new) - end])
+
+    if type(old) is type(new) and old == new:
+        return None
+    return ("replace", new)
+
+
+def _diff_map_nodes(old: Any, new: Any, changed: dict, removed: list) -> None:
+    if old is new:
+        return
+    if type(old) is list and type(new) is list:
+        for old_child, new_child in zip(old, new):
+            _diff_map_nodes(old_child, new_child, changed, removed)
+        return
+
+    # a leaf or a collision on one side, compare the keys of both subtrees
+    old_items = dict(PersistentMap._node_items(old))
+    for key, value in PersistentMap._node_items(new):
+        if key not in old_items:
+            changed[key] = ("replace", value)
+            continue
+        patch = diff(old_items.pop(key), value)
+        if patch is not None:
+            changed[key] = patch
+    removed.extend(old_items)
+
+
+# `old` is None for the subtrees appended to the vector
+def _diff_vector_nodes(old: Any, new: list, shift: int, offset: int, changed: dict) -> None:
+    if old is new:
+        return
+    for position, item in enumerate(new):
+        old_item = old[position] if old is not None and position < len(old) else None
+        if shift:
+            _diff_vector_nodes(
+                old_item, item, shift - _BITS, offset + (position << shift), changed
+            )
+        elif old is None or position >= len(old):
+            changed[offset + position] = ("replace", item)
+        else:
+            patch = diff(old_item, item)
+            if patch is not None:
+                changed[offset + position] = patch
+
+
+# returns a new state, the containers outside the patched path are shared with `state`
+def apply_patch(state: Any, patch: Optional[tuple]) -> Any:
+    if patch is None:
+        return state
+
+    kind = patch[0]
+    if kind == "replace":
+        return patch[1]
+    if kind == "dict":
+        _, changed, removed = patch
+        new_state = dict(state)
+        for key, key_patch in changed.items():
+            new_state[key] = apply_patch(state.get(key), key_patch)
+        for key in removed:
+            del new_state[key]
+        return new_state
+    if kind == "splice":
+        _, start, stop, items = patch
+        return state[:start] + items + state[stop:]
+    if kind == "map":
+        _, changed, removed = patch
+        for key, key_patch in changed.items():
+            state = state.set(key, apply_patch(state.get(key), key_patch))
+        for key in removed:
+            state = state.delete(key)
+        return state
+    if kind == "vector":
+        # in index order, so the new items are appended one after the other
+        for index, item_patch in sorted(patch[1].items()):
+            item = state[index] if index < len(state) else None
+            state = state.set(index, apply_patch(item, item_patch))
+        return state
+
+    raise ValueError(f"Invalid patch: {kind}")
+
+
+def _is_persistent(value: Any) -> bool:
+    return isinstance(value, (PersistentMap, PersistentVector))
+
+
+# a persistent state can not change, so it is shared instead of copied
+def _private_copy(state: Any) -> Any:
+    return state if _is_persistent(state) else copy.deepcopy(state)
+
+
+class DeltaCareTaker(CareTaker):
+    """Stores the history as keyframes (full copies) followed by patches, so memory
+    grows with the size of the edits. A keyframe is taken every `keyframe_interval`
+    snapshots to keep the cost of a restore bounded. The history can be capped by
+    number of snapshots and by (approximate, pickled) bytes, and supports redo"""
+
+    _history: List[Tuple[bool, Any, int]]
+
+    def __init__(
+        self,
+        originator: Originator,
+        keyframe_interval: int = 32,
+        max_snapshots: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+    ) -> None:
+        super().__init__(originator)
+        self.keyframe_interval = keyframe_interval
+        self.max_snapshots = max_snapshots
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # entries before the cursor can be undone, the others redone
+        self._cursor = 0
+        # a private copy of the state of the entry before the cursor
+        self._last_state: Any = None
+
+    def __len__(self) -> int:
+        return self._cursor
+
+    def _append(self, is_keyframe: bool, data: Any) -> None:
+        size = len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+        self._history.append((is_keyframe, data, size))
+        self.total_bytes += size
+
+    def add_snapshot(self) -> Memento:
+        # a new snapshot discards the redo history
+        for _, _, size in self._history[self._cursor:]:
+            self.total_bytes -= size
+        del self._history[self._cursor:]
+
+        memento = self._originator.save()
+        state = memento.state
+        if self._patches_since_keyframe() + 1 >= self.keyframe_interval:
+            self._last_state = _private_copy(state)
+            self._append(True, self._last_state)
+        else:
+            # only the changed values are copied
+            patch = copy.deepcopy(diff(self._last_state, state))
+            # a persistent state is kept as it is, so the next diff skips the
+            # subtrees it still shares with the originator
+            if _is_persistent(state):
+                self._last_state = state
+            else:
+                self._last_state = apply_patch(self._last_state, patch)
+            self._append(False, patch)
+
+        self._cursor += 1
+        self._trim()
+        return memento
+
+    # number of patches between the last keyframe and the cursor, or the
+    # interval itself when there is no keyframe yet
+    def _patches_since_keyframe(self) -> int:
+        for distance, index in enumerate(range(self._cursor - 1, -1, -1)):
+            if self._history[index][0]:
+                return distance
+        return self.keyframe_interval
+
+    def _trim(self) -> None:
+        while len(self._history) > 1 and (
+            (self.max_snapshots is not None and len(self._history) > self.max_snapshots)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            second_state = self._state_at(1)
+            _, _, size = self._history.pop(0)
+            self.total_bytes -= size
+            self._cursor -= 1
+            # the new first entry must be a keyframe to be restorable
+            if not self._history[0][0]:
+                self.total_bytes -= self._history[0][2]
+                size = len(pickle.dumps(second_state, pickle.HIGHEST_PROTOCOL))
+                self._history[0] = (True, second_state, size)
+                self.total_bytes += size
+
+    def _state_at(self, index: int) -> Any:
+        keyframe = index
+        while not self._history[keyframe][0]:
+            keyframe -= 1
+
+        state = self._history[keyframe][1]
+        for _, patch, _ in self._history[keyframe + 1:index + 1]:
+            state = apply_patch(state, patch)
+        return state
+
+    def undo_snapshot(self) -> Memento:
+        if not self._cursor:
+            raise IndexError("undo from empty history")
+
+        self._cursor -= 1
+        state = self._state_at(self._cursor)
+        self._last_state = self._state_at(self._cursor - 1) if self._cursor else None
+        return Memento(_private_copy(state))
+
+    def redo_snapshot(self) -> Memento:
+        if self._cursor == len(self._history):
+            raise IndexError("nothing to redo")
+
+        self._last_state = self._state_at(self._cursor)
+        self._cursor += 1
+        return Memento(_private_copy(self._last_state))
+
+
+class SpillingCareTaker(CareTaker):
+    """Keeps the `max_in_memory` most recent snapshots in memory and moves the older
+    ones, pickled and compressed, to an append-only log on disk. Undoing past the
+    memory window reads them back lazily. The states are pickled when they are
+    spilled, so they should not be mutated after the snapshot (see `freeze`)"""
+
+    _history: Deque[Memento]
+    _spilled: List[Tuple[int, int]]
+
+    def __init__(
+        self,
+        originator: Originator,
+        path: Optional[str] = None,
+        max_in_memory: int = 100,
+        compression_level: int = 6,
+    ) -> None:
+        super().__init__(originator)
+        self._history = deque()
+        self.max_in_memory = max_in_memory
+        self.compression_level = compression_level
+        # only a temporary log is removed by close, a given path is kept
+        self._owns_file = path is None
+        if path is None:
+            file_descriptor, path = tempfile.mkstemp(suffix=".history")
+            os.close(file_descriptor)
+        self.path = path
+        self._file = open(path, "w+b")
+        # (offset, size) of each spilled snapshot, oldest first
+        self._spilled = []
+
+    def __len__(self) -> int:
+        return len(self._history) + len(self._spilled)
+
+    @property
+    def spilled_bytes(self) -> int:
+        return sum(size for _, size in self._spilled)
+
+    def add_snapshot(self) -> Memento:
+        memento = super().add_snapshot()
+        if len(self._history) > self.max_in_memory:
+            self._spill(self._history.popleft())
+        return memento
+
+    def _spill(self, memento: Memento) -> None:
+        data = zlib.compress(
+            pickle.dumps(memento.state, pickle.HIGHEST_PROTOCOL), self.compression_level
+        )
+        offset = self._spilled[-1][0] + self._spilled[-1][1] if self._spilled else 0
+        self._file.seek(offset)
+        self._file.write(data)
+        self._spilled.append((offset, len(data)))
+
+    def undo_snapshot(self) -> Memento:
+        if self._history:
+            return self._history.pop()
+        if not self._spilled:
+            raise IndexError("undo from empty history")
+
+        offset, size = self._spilled.pop()
+        self._file.seek(offset)
+        data = self._file.read(size)
+        # the log only grows at the end, so the read snapshot can be cut off
+        self._file.truncate(offset)
+        return Memento(pickle.loads(zlib.decompress(data)))
+
+    def close(self) -> None:
+        self._file.close()
+        if self._owns_file:
+            os.remove(self.path)
+
+
+if __name__ == "__main__":
+    document = {"title": "draft", "paragraphs": [f"paragraph {i}" for i in range(1000)]}
+    editor = Originator(document)
+    history = DeltaCareTaker(editor, keyframe_interval=10, max_snapshots=50)
+
+    for version in range(100):
+        document["paragraphs"][version] = f"edited paragraph {version}"
+        document["title"] = f"draft {version}"
+        history.add_snapshot()
+
+    print(f"{len(history)} snapshots using {history.total_bytes} bytes")
+
+    last = history.undo_snapshot()
+    previous = history.undo_snapshot()
+    assert last.state["title"] == "draft 99"
+    assert previous.state["title"] == "draft 98"
+    assert previous.state["paragraphs"][99] == "paragraph 99"
+
+    editor.restore(history.redo_snapshot())
+    assert editor.save().state["title"] == "draft 98"
+    print("history working properly!")
+
+    # with a persistent state, saving is O(1) and the snapshots can not be corrupted
+    editor = Originator(freeze(document))
+    snapshot = editor.save()
+    editor.restore(Memento(editor.save().state.set("title", "final")))
+    assert snapshot.state["title"] == "draft 99"
+    assert editor.save().state["title"] == "final"
+    assert thaw(snapshot.state) == document
+    print("persistent state working properly!")
+
+    # only the 10 most recent snapshots stay in memory, the others go to disk
+    history = SpillingCareTaker(editor, max_in_memory=10)
+    for version in range(100):
+        editor.restore(Memento(editor.save().state.set("title", f"version {version}")))
+        history.add_snapshot()
+
+    print(f"{len(history)} snapshots, {history.spilled_bytes} bytes on disk")
+    for version in reversed(range(100)):
+        assert history.undo_snapshot().state["title"] == f"version {version}"
+    history.close()
+    print("spilled history working properly!")
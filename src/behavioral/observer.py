@@ -1,6 +1,26 @@
 from __future__ import annotations
+import asyncio
+import inspect
+import threading
+import weakref
+from itertools import count
 from abc import ABC, abstractmethod
-from typing import List
+from collections import deque
+from heapq import merge
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 
 # Subscriber
@@ -10,35 +30,410 @@ class BaseObserver(ABC):
         pass
 
 
+def print_observer_error(observer: BaseObserver, error: Exception):
+    print(f"{observer.__class__.__name__} failed: {error!r}")
+
+
+# the dispatchers decide how the observers are called. They are strategies of the
+# subject: every dispatcher isolates the errors, so a failing observer does not
+# stop the others from being notified
+class BaseDispatcher(ABC):
+    errors: int
+
+    def __init__(
+        self, on_error: Callable[[BaseObserver, Exception], None] = print_observer_error
+    ) -> None:
+        self.on_error = on_error
+        self.errors = 0
+
+    @abstractmethod
+    def dispatch(self, observers: List[BaseObserver], state: dict):
+        pass
+
+    def close(self):
+        pass
+
+    def _deliver(self, observer: BaseObserver, state: dict):
+        try:
+            observer.update(state)
+        except Exception as error:
+            self.errors += 1
+            self.on_error(observer, error)
+
+
+# calls the observers one after another on the publisher thread
+class SyncDispatcher(BaseDispatcher):
+    def dispatch(self, observers: List[BaseObserver], state: dict):
+        for observer in observers:
+            self._deliver(observer, state)
+
+
+# each observer has its own queue that is drained by a thread pool, so a slow
+# observer only delays its own notifications. When a queue holds `max_pending`
+# notifications the publisher either waits for room (block=True) or the oldest
+# notification is dropped
+class ThreadPoolDispatcher(BaseDispatcher):
+    dropped: int
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_pending: int = 1000,
+        block: bool = False,
+        on_error: Callable[[BaseObserver, Exception], None] = print_observer_error,
+    ) -> None:
+        super().__init__(on_error)
+        self.max_pending = max_pending
+        self.block = block
+        self.dropped = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._queues: Dict[int, Deque[dict]] = {}
+        self._running: set = set()
+        self._condition = threading.Condition()
+
+    def dispatch(self, observers: List[BaseObserver], state: dict):
+        for observer in observers:
+            with self._condition:
+                queue = self._queues.setdefault(id(observer), deque())
+                while self.block and len(queue) >= self.max_pending:
+                    self._condition.wait()
+                    # the drain may have emptied and removed the queue meanwhile
+                    queue = self._queues.setdefault(id(observer), deque())
+                if len(queue) >= self.max_pending:
+                    queue.popleft()
+                    self.dropped += 1
+
+                queue.append(state)
+                if id(observer) in self._running:
+                    continue
+                self._running.add(id(observer))
+
+            self._executor.submit(self._drain, observer, queue)
+
+    def _drain(self, observer: BaseObserver, queue: Deque[dict]):
+        while True:
+            with self._condition:
+                if not queue:
+                    if self._queues.get(id(observer)) is queue:
+                        del self._queues[id(observer)]
+                    self._running.discard(id(observer))
+                    self._condition.notify_all()
+                    return
+                state = queue.popleft()
+                self._condition.notify_all()
+
+            self._deliver(observer, state)
+
+    # wait until every queued notification was delivered
+    def join(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._running)
+
+    def close(self):
+        self.join()
+        self._executor.shutdown()
+
+
+# each observer has an asyncio queue consumed by its own task. `update` can be a
+# regular method or a coroutine. It must be used inside a running event loop
+class AsyncioDispatcher(BaseDispatcher):
+    dropped: int
+
+    def __init__(
+        self,
+        max_pending: int = 1000,
+        on_error: Callable[[BaseObserver, Exception], None] = print_observer_error,
+    ) -> None:
+        super().__init__(on_error)
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._queues: Dict[int, asyncio.Queue] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def dispatch(self, observers: List[BaseObserver], state: dict):
+        for observer in observers:
+            queue = self._queues.get(id(observer))
+            if queue is None:
+                queue = self._queues[id(observer)] = asyncio.Queue(self.max_pending)
+                self._tasks.append(asyncio.ensure_future(self._consume(observer, queue)))
+
+            if queue.full():
+                queue.get_nowait()
+                queue.task_done()
+                self.dropped += 1
+            queue.put_nowait(state)
+
+    async def _consume(self, observer: BaseObserver, queue: asyncio.Queue):
+        while True:
+            state = await queue.get()
+            try:
+                result = observer.update(state)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as error:
+                self.errors += 1
+                self.on_error(observer, error)
+            finally:
+                queue.task_done()
+
+    async def join(self):
+        for queue in list(self._queues.values()):
+            await queue.join()
+
+    async def aclose(self):
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+# what an observer wants to receive: only the changes of some keys (topics),
+# keys starting with a prefix or keys accepted by a predicate, and/or only the
+# changed values instead of the whole state
+class Subscription:
+    __slots__ = ("keys", "prefixes", "predicate", "deltas")
+
+    def __init__(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        deltas: bool = False,
+        predicate: Optional[Callable[[str], bool]] = None,
+    ) -> None:
+        self.keys = frozenset(keys) if keys is not None else None
+        self.prefixes = tuple(prefixes) if prefixes is not None else None
+        self.predicate = predicate
+        self.deltas = deltas
+
+    @property
+    def is_filtered(self) -> bool:
+        return self.keys is not None or self.needs_scan
+
+    # prefixes and predicates can not be indexed, they are checked on every change
+    @property
+    def needs_scan(self) -> bool:
+        return self.prefixes is not None or self.predicate is not None
+
+    def matches(self, key: str) -> bool:
+        if not self.is_filtered:
+            return True
+        return (
+            (self.keys is not None and key in self.keys)
+            or (self.prefixes is not None and key.startswith(self.prefixes))
+            or (self.predicate is not None and self.predicate(key))
+        )
+
+    def select(self, changes: dict) -> dict:
+        if not self.is_filtered:
+            return changes
+        return {key: value for key, value in changes.items() if self.matches(key)}
+
+
+# the subscribers of a subject. Every observer gets an increasing token, so the
+# registry is an insertion ordered dict with O(1) subscribe and unsubscribe.
+# Observers subscribed to keys are also indexed by key, so a change only reaches
+# the observers interested in it. Weak observers are removed automatically when
+# they are garbage collected
+class ObserverRegistry:
+    _entries: Dict[int, Tuple[Any, Subscription, int]]
+    _tokens: Dict[int, int]
+    _by_key: Dict[str, Set[int]]
+    _unfiltered: Dict[int, None]
+    _scanned: Dict[int, None]
+
+    def __init__(self) -> None:
+        self._counter = count()
+        self._entries = {}
+        self._tokens = {}
+        self._by_key = {}
+        self._unfiltered = {}
+        self._scanned = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, observer: BaseObserver) -> bool:
+        return id(observer) in self._tokens
+
+    def __iter__(self) -> Iterator[BaseObserver]:
+        for reference, _, _ in list(self._entries.values()):
+            observer = reference()
+            if observer is not None:
+                yield observer
+
+    def add(self, observer: BaseObserver, subscription: Subscription, weak: bool = False):
+        if observer in self:
+            self.remove(observer)
+
+        token = next(self._counter)
+        if weak:
+            reference = weakref.ref(observer, lambda _: self._discard(token))
+        else:
+            # a strong "reference" with the same interface as weakref.ref
+            def reference():
+                return observer
+
+        self._entries[token] = (reference, subscription, id(observer))
+        self._tokens[id(observer)] = token
+        if subscription.keys is not None:
+            for key in subscription.keys:
+                self._by_key.setdefault(key, set()).add(token)
+        if subscription.needs_scan:
+            self._scanned[token] = None
+        if not subscription.is_filtered:
+            self._unfiltered[token] = None
+
+    def remove(self, observer: BaseObserver):
+        token = self._tokens.get(id(observer))
+        if token is None:
+            raise ValueError(f"{observer!r} is not subscribed")
+        self._discard(token)
+
+    def _discard(self, token: int):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+
+        _, subscription, observer_id = entry
+        # the id of a collected observer may already belong to a new one
+        if self._tokens.get(observer_id) == token:
+            del self._tokens[observer_id]
+
+        if subscription.keys is not None:
+            for key in subscription.keys:
+                tokens = self._by_key[key]
+                tokens.discard(token)
+                if not tokens:
+                    del self._by_key[key]
+        self._scanned.pop(token, None)
+        self._unfiltered.pop(token, None)
+
+    # the (observer, subscription) pairs interested in the changed keys, in
+    # subscription order
+    def route(self, changes: dict) -> List[Tuple[BaseObserver, Subscription]]:
+        # only the keyed and scanned matches need sorting, the unfiltered tokens
+        # are already in subscription order
+        matched = set()
+        smaller, larger = changes, self._by_key
+        if len(smaller) > len(larger):
+            smaller, larger = larger, smaller
+        for key in smaller:
+            if key in larger:
+                matched.update(self._by_key[key])
+        for token in self._scanned:
+            if token not in matched:
+                subscription = self._entries[token][1]
+                if any(subscription.matches(key) for key in changes):
+                    matched.add(token)
+        matched.difference_update(self._unfiltered)
+
+        # a collected weak observer may leave _unfiltered while we walk it
+        tokens = list(self._unfiltered)
+        if matched:
+            tokens = merge(tokens, sorted(matched))
+
+        routed = []
+        entries = self._entries
+        for token in tokens:
+            entry = entries.get(token)
+            if entry is not None:
+                observer = entry[0]()
+                if observer is not None:
+                    routed.append((observer, entry[1]))
+        return routed
+
+
 # Publisher
 class BaseSubject(ABC):
-    listeners: List[BaseObserver]
+    registry: ObserverRegistry
     state: dict
+    dispatcher: BaseDispatcher
+    _pending: dict
+    _batch_depth: int
 
-    def __init__(self, initial_state: dict = None) -> None:
-        self.listeners = []
+    def __init__(
+        self, initial_state: dict = None, dispatcher: Optional[BaseDispatcher] = None
+    ) -> None:
+        self.registry = ObserverRegistry()
         self.state = initial_state
+        self.dispatcher = dispatcher if dispatcher is not None else SyncDispatcher()
+        self._pending = {}
+        self._batch_depth = 0
 
         if not initial_state:
             self.state = {}
 
-    def subscribe(self, observer: BaseObserver):
-        self.listeners.append(observer)
+    @property
+    def listeners(self) -> List[BaseObserver]:
+        return list(self.registry)
+
+    # without options the observer receives the whole state on every change.
+    # A weak subscription does not keep the observer alive
+    def subscribe(
+        self,
+        observer: BaseObserver,
+        keys: Optional[Iterable[str]] = None,
+        prefixes: Optional[Iterable[str]] = None,
+        deltas: bool = False,
+        predicate: Optional[Callable[[str], bool]] = None,
+        weak: bool = False,
+    ):
+        self.registry.add(observer, Subscription(keys, prefixes, deltas, predicate), weak)
 
     def unsubscribe(self, observer: BaseObserver):
-        self.listeners.remove(observer)
+        self.registry.remove(observer)
+
+    def set_state(self, key: str, value):
+        self.state[key] = value
+        self._pending[key] = value
+        if not self._batch_depth:
+            self._flush()
+
+    # inside a batch the changes are coalesced (only the last value of each key
+    # is kept) and the observers are notified once, when the batch ends
+    @contextmanager
+    def batch(self) -> Iterator[BaseSubject]:
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            changes, self._pending = self._pending, {}
+            self.notify_all(changes)
+
+    def notify_all(self, changes: Optional[dict] = None):
+        # without changes, everything is considered changed
+        if changes is None:
+            changes = self.state
 
-    def notify_all(self):
-        for observer in self.listeners:
-            print(f"{observer.__class__.__name__} notified!")
-            observer.update(self.state)
+        full_state_observers = []
+        delta_deliveries: List[Tuple[BaseObserver, dict]] = []
+        for observer, subscription in self.registry.route(changes):
+            if subscription.deltas:
+                delta_deliveries.append((observer, dict(subscription.select(changes))))
+            else:
+                full_state_observers.append(observer)
+
+        if full_state_observers:
+            # the observers may run later, so they receive a snapshot of the state
+            state = self.state
+            if not isinstance(self.dispatcher, SyncDispatcher):
+                state = dict(state)
+            self.dispatcher.dispatch(full_state_observers, state)
+
+        for observer, delta in delta_deliveries:
+            self.dispatcher.dispatch([observer], delta)
 
 
 # notify all listeners if a game is on sale
 class GameOnSalePublisher(BaseSubject):
     def set_game_on_sale(self, game: str, value: float):
-        self.state[game] = value
-        self.notify_all()
+        self.set_state(game, value)
 
 
 class SendEmailObserver(BaseObserver):
@@ -51,6 +446,24 @@ class UpdateShopWithPricesObserver(BaseObserver):
         print("Updating store with the new values")
 
 
+class PriceIndexObserver(BaseObserver):
+    def update(self, state: dict):
+        print(f"Reindexing prices of {len(state)} games")
+
+
+class BrokenObserver(BaseObserver):
+    def update(self, state: dict):
+        raise RuntimeError("the shop is offline")
+
+
+async def run_async_example():
+    dispatcher = AsyncioDispatcher()
+    publisher = GameOnSalePublisher(dispatcher=dispatcher)
+    publisher.subscribe(SendEmailObserver())
+    publisher.set_game_on_sale("disco elysium", 19.99)
+    await dispatcher.aclose()
+
+
 # example
 if __name__ == "__main__":
     publisher = GameOnSalePublisher({})
@@ -58,3 +471,53 @@ if __name__ == "__main__":
     publisher.subscribe(UpdateShopWithPricesObserver())
 
     publisher.set_game_on_sale("fallout new vegas", 9.99)
+
+    # a failing observer does not stop the others
+    publisher.subscribe(BrokenObserver())
+    publisher.set_game_on_sale("baldurs gate 3", 39.99)
+
+    # a bulk import notifies each observer once, with only the changes it cares about
+    import_publisher = GameOnSalePublisher()
+    import_publisher.subscribe(PriceIndexObserver(), deltas=True)
+    import_publisher.subscribe(SendEmailObserver(), prefixes=["fallout"], deltas=True)
+    with import_publisher.batch():
+        for index in range(100_000):
+            import_publisher.set_game_on_sale(f"game {index}", 4.99)
+        import_publisher.set_game_on_sale("fallout 4", 14.99)
+
+    # only the observers of a game are notified, and weak observers go away alone
+    routed_publisher = GameOnSalePublisher()
+    wishlist_observer = SendEmailObserver()
+    routed_publisher.subscribe(wishlist_observer, keys=["celeste"], weak=True)
+    routed_publisher.subscribe(UpdateShopWithPricesObserver(), keys=["hades"])
+    routed_publisher.set_game_on_sale("celeste", 4.99)
+    del wishlist_observer
+    assert len(routed_publisher.registry) == 1
+
+    # the observers run on a thread pool, the publisher does not wait for them
+    dispatcher = ThreadPoolDispatcher(max_workers=2)
+    threaded_publisher = GameOnSalePublisher(dispatcher=dispatcher)
+    threaded_publisher.subscribe(SendEmailObserver())
+    threaded_publisher.subscribe(UpdateShopWithPricesObserver())
+    threaded_publisher.set_game_on_sale("hollow knight", 7.49)
+    dispatcher.close()
+
+    # in blocking mode the publisher waits for room, nothing is dropped
+    class CountingObserver(BaseObserver):
+        def __init__(self) -> None:
+            self.updates = 0
+
+        def update(self, state: dict):
+            self.updates += 1
+
+    counting_observer = CountingObserver()
+    blocking_dispatcher = ThreadPoolDispatcher(max_pending=1, block=True)
+    blocking_publisher = GameOnSalePublisher(dispatcher=blocking_dispatcher)
+    blocking_publisher.subscribe(counting_observer)
+    for index in range(200):
+        blocking_publisher.set_game_on_sale(f"game {index}", 1.99)
+    blocking_dispatcher.close()
+    assert counting_observer.updates == 200
+    assert blocking_dispatcher.dropped == 0
+
+    asyncio.run(run_async_example())
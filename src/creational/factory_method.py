@@ -3,9 +3,46 @@
 # it is important to note that factory methods can also be used inside classes and another abstractions
 
 from abc import ABC, abstractmethod
-from typing import Literal, Union
-import json
-import pickle
+from array import array
+from collections import deque
+from itertools import islice
+from typing import (
+    BinaryIO,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Tuple,
+    Type,
+    Union,
+)
+import importlib
+import io
+import mmap
+import os
+import struct
+import sys
+
+
+# the serializer modules are only imported when an exporter uses them for the
+# first time, so a tool that needs only one format does not pay for the others
+class _LazyModule:
+    def __init__(self, name: str) -> None:
+        self._name = name
+
+    def __getattr__(self, attribute: str):
+        module = importlib.import_module(self._name)
+        # the next uses of the name go straight to the module
+        globals()[self._name] = module
+        return getattr(module, attribute)
+
+
+gzip = _LazyModule("gzip")
+json = _LazyModule("json")
+pickle = _LazyModule("pickle")
+
 
 # First we need to create a base class for all the exporters
 class Exporter(ABC):
@@ -26,14 +63,458 @@ class BinaryExporter(Exporter):
         return pickle.dumps(data)
 
 
+# The streaming exporters write the records one by one to a file or buffer,
+# so the whole output never needs to be in memory. With `compress`, the output
+# is gzip compressed while it is written
+class StreamExporter(Exporter):
+    def __init__(self, compress: bool = False, buffer_size: int = 64 * 1024) -> None:
+        self.compress = compress
+        self.buffer_size = buffer_size
+
+    def export(self, data: Union[dict, list]):
+        output = io.BytesIO()
+        self.export_to(data if isinstance(data, list) else [data], output)
+        return output.getvalue()
+
+    def export_to(self, records: Iterable, output: BinaryIO) -> int:
+        """writes the records to `output` and returns how many were written"""
+        if self.compress:
+            with gzip.GzipFile(fileobj=output, mode="wb") as compressed:
+                return self._write(records, compressed)
+        return self._write(records, output)
+
+    def _write(self, records: Iterable, output: BinaryIO) -> int:
+        # small writes are grouped in chunks of about `buffer_size` bytes
+        chunk = []
+        chunk_size = 0
+        count = 0
+        for record in records:
+            encoded = self.encode(record)
+            chunk.append(encoded)
+            chunk_size += len(encoded)
+            count += 1
+            if chunk_size >= self.buffer_size:
+                output.write(b"".join(chunk))
+                chunk = []
+                chunk_size = 0
+        if chunk:
+            output.write(b"".join(chunk))
+        return count
+
+    def load_from(self, source: BinaryIO) -> Iterator:
+        """reads the records back, one at a time"""
+        if self.compress:
+            source = gzip.GzipFile(fileobj=source, mode="rb")
+        return self.decode(source)
+
+    @abstractmethod
+    def encode(self, record) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, source: BinaryIO) -> Iterator:
+        pass
+
+
+# one JSON document per line (NDJSON)
+class NdjsonStreamExporter(StreamExporter):
+    def encode(self, record) -> bytes:
+        return json.dumps(record).encode("utf-8") + b"\n"
+
+    def decode(self, source: BinaryIO) -> Iterator:
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+
+# each record is pickled in a frame prefixed by its length
+class FramedBinaryStreamExporter(StreamExporter):
+    _header = struct.Struct("<I")
+
+    def encode(self, record) -> bytes:
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        return self._header.pack(len(data)) + data
+
+    def decode(self, source: BinaryIO) -> Iterator:
+        while True:
+            header = source.read(self._header.size)
+            if len(header) < self._header.size:
+                return
+            (size,) = self._header.unpack(header)
+            yield pickle.loads(source.read(size))
+
+
+# A columnar binary format for lists of dicts. The records are written in
+# batches, each batch has a JSON header with the schema (inferred once per batch,
+# from all the keys of the batch) followed by the buffers of each column:
+#   numbers and booleans -> the raw bytes of an array
+#   strings              -> an array of end offsets and the utf-8 bytes
+#   anything else        -> a pickled list (slow path, for mixed values or
+#                           integers that do not fit in 64 bits)
+# When some rows miss the key or hold None, the column starts with a mask
+# (MISSING, NULL or PRESENT per row) and only the present values are stored
+class ColumnarExporter(Exporter):
+    _magic = b"COL1"
+    _header = struct.Struct("<4sI")
+    _typecodes = {bool: "b", int: "q", float: "d"}
+
+    MISSING = 0
+    NULL = 1
+    PRESENT = 2
+
+    def __init__(self, batch_size: int = 65_536) -> None:
+        self.batch_size = batch_size
+
+    def export(self, data: Union[dict, list]):
+        output = io.BytesIO()
+        self.export_to(data if isinstance(data, list) else [data], output)
+        return output.getvalue()
+
+    def export_to(self, records: Iterable[dict], output: BinaryIO) -> int:
+        records = iter(records)
+        count = 0
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                return count
+            self._write_batch(batch, output)
+            count += len(batch)
+
+    def _infer_type(self, values: list) -> str:
+        if not values:
+            return "pickle"
+        value_type = type(values[0])
+        if all(type(value) is value_type for value in values):
+            # the integers that do not fit in an int64 array take the slow path
+            if value_type is int and not (-(2**63) <= min(values) and max(values) < 2**63):
+                return "pickle"
+            if value_type in self._typecodes:
+                return self._typecodes[value_type]
+            if value_type is str:
+                return "str"
+        return "pickle"
+
+    def _encode_column(self, values: list, column_type: str) -> List[bytes]:
+        if column_type == "str":
+            encoded = [value.encode("utf-8") for value in values]
+            offsets = array("Q")
+            end = 0
+            for value in encoded:
+                end += len(value)
+                offsets.append(end)
+            return [offsets.tobytes(), b"".join(encoded)]
+        if column_type == "pickle":
+            return [pickle.dumps(values, pickle.HIGHEST_PROTOCOL)]
+        return [array(column_type, values).tobytes()]
+
+    def _write_batch(self, batch: List[dict], output: BinaryIO):
+        # the union of the keys, in the order they are first seen
+        names = list(dict.fromkeys(key for record in batch for key in record))
+        columns = []
+        buffers: List[bytes] = []
+        for name in names:
+            mask = array("b")
+            values = []
+            for record in batch:
+                value = record.get(name, _MISSING)
+                if value is _MISSING:
+                    mask.append(self.MISSING)
+                elif value is None:
+                    mask.append(self.NULL)
+                else:
+                    mask.append(self.PRESENT)
+                    values.append(value)
+
+            masked = len(values) != len(batch)
+            column_type = self._infer_type(values)
+            column_buffers = self._encode_column(values, column_type)
+            if masked:
+                column_buffers.insert(0, mask.tobytes())
+            sizes = [len(buffer) for buffer in column_buffers]
+            columns.append(
+                {"name": name, "type": column_type, "masked": masked, "sizes": sizes}
+            )
+            buffers.extend(column_buffers)
+
+        header = json.dumps(
+            {"rows": len(batch), "byteorder": sys.byteorder, "columns": columns}
+        ).encode("utf-8")
+        output.write(self._header.pack(self._magic, len(header)))
+        output.write(header)
+        output.write(_padding(self._header.size + len(header)))
+        for buffer in buffers:
+            output.write(buffer)
+            output.write(_padding(len(buffer)))
+
+
+_MISSING = object()
+
+
+# the buffers are aligned to 8 bytes so they can be viewed as arrays in place
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % 8)
+
+
+class ColumnarReader:
+    """Reads the columnar format without copying: the numeric columns are
+    memoryviews over the source buffer (bytes, or a mmap of the file)"""
+
+    def __init__(self, buffer) -> None:
+        self._view = memoryview(buffer)
+
+    @classmethod
+    def open(cls, path: str) -> "ColumnarReader":
+        with open(path, "rb") as source:
+            return cls(mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def batches(self) -> Iterator["ColumnarBatch"]:
+        header_struct = ColumnarExporter._header
+        offset = 0
+        while offset < len(self._view):
+            magic, header_size = header_struct.unpack_from(self._view, offset)
+            if magic != ColumnarExporter._magic:
+                raise ValueError("Invalid columnar data")
+            offset += header_struct.size
+            header = json.loads(bytes(self._view[offset:offset + header_size]))
+            if header["byteorder"] != sys.byteorder:
+                raise ValueError("The data was written with another byte order")
+            offset += header_size
+            offset += -offset % 8
+
+            batch = ColumnarBatch(header["rows"])
+            for column in header["columns"]:
+                buffers = []
+                for size in column["sizes"]:
+                    buffers.append(self._view[offset:offset + size])
+                    offset += size + (-size % 8)
+                if column.get("masked"):
+                    mask = buffers.pop(0).cast("b")
+                    values = self._decode_column(column["type"], buffers)
+                    batch[column["name"]] = _MaskedColumn(values, mask)
+                else:
+                    batch[column["name"]] = self._decode_column(column["type"], buffers)
+            yield batch
+
+    @staticmethod
+    def _decode_column(column_type: str, buffers: List[memoryview]):
+        if column_type == "str":
+            offsets = buffers[0].cast("Q")
+            data = buffers[1]
+            return _StringColumn(offsets, data)
+        if column_type == "pickle":
+            return pickle.loads(buffers[0])
+        if column_type == "b":
+            return buffers[0].cast("?")
+        return buffers[0].cast(column_type)
+
+    def rows(self) -> Iterator[dict]:
+        for batch in self.batches():
+            names = list(batch)
+            masks = [
+                column.mask if isinstance(column, _MaskedColumn) else None
+                for column in batch.values()
+            ]
+            # a batch of empty records has no columns, but still has its rows
+            columns = [iter(column) for column in batch.values()]
+            for index in range(batch.rows):
+                values = [next(column) for column in columns]
+                yield {
+                    name: value
+                    for name, value, mask in zip(names, values, masks)
+                    if mask is None or mask[index] != ColumnarExporter.MISSING
+                }
+
+
+class ColumnarBatch(dict):
+    """The columns of a batch by name, and its number of rows"""
+
+    def __init__(self, rows: int) -> None:
+        super().__init__()
+        self.rows = rows
+
+
+# a column with missing or None values: the dense present values and a mask.
+# Missing and None rows are both read as None, the mask tells them apart
+class _MaskedColumn:
+    def __init__(self, values, mask: memoryview) -> None:
+        self.values = values
+        self.mask = mask
+        # the position of each row in the dense values, -1 when it has no value
+        self._positions = array("q")
+        position = 0
+        for state in mask:
+            if state == ColumnarExporter.PRESENT:
+                self._positions.append(position)
+                position += 1
+            else:
+                self._positions.append(-1)
+
+    def __len__(self) -> int:
+        return len(self.mask)
+
+    def __getitem__(self, index: int):
+        position = self._positions[index]
+        return self.values[position] if position >= 0 else None
+
+    def __iter__(self) -> Iterator:
+        values = iter(self.values)
+        for state in self.mask:
+            yield next(values) if state == ColumnarExporter.PRESENT else None
+
+
+# a lazy sequence of the strings of a column, decoded when they are accessed
+class _StringColumn:
+    def __init__(self, offsets: memoryview, data: memoryview) -> None:
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        start = self._offsets[index - 1] if index else 0
+        return str(self._data[start:self._offsets[index]], "utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        data = bytes(self._data)
+        start = 0
+        for end in self._offsets:
+            yield data[start:end].decode("utf-8")
+            start = end
+
+
+# the exporters are registered by name, with a streaming variant or not
+_exporters: Dict[Tuple[str, bool], Type[Exporter]] = {}
+# the exporters keep no state between calls, so a single instance is reused
+_instances: Dict[Tuple[str, bool, bool], Exporter] = {}
+_entry_points_loaded = False
+
+ENTRY_POINT_GROUP = "design_patterns.exporters"
+
+
+def register_exporter(name: str, streaming: bool = False):
+    """class decorator adding an exporter to the ExportFactory"""
+
+    def decorator(exporter_class: Type[Exporter]) -> Type[Exporter]:
+        _exporters[(name, streaming)] = exporter_class
+        for key in [key for key in _instances if key[:2] == (name, streaming)]:
+            del _instances[key]
+        return exporter_class
+
+    return decorator
+
+
+# other packages can provide exporters with an entry point in the group
+# "design_patterns.exporters", they are only looked up for an unknown format
+def _load_entry_points():
+    global _entry_points_loaded
+    _entry_points_loaded = True
+
+    from importlib.metadata import entry_points
+
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        exporter_class = entry_point.load()
+        streaming = issubclass(exporter_class, StreamExporter)
+        _exporters.setdefault((entry_point.name, streaming), exporter_class)
+
+
+def _find_exporter(format_type: str, streaming: bool) -> Type[Exporter]:
+    known = (format_type, False) in _exporters or (format_type, True) in _exporters
+    if not known and not _entry_points_loaded:
+        _load_entry_points()
+
+    exporter_class = _exporters.get((format_type, streaming))
+    # a format without a streaming variant (like columnar) already streams
+    if exporter_class is None and streaming:
+        exporter_class = _exporters.get((format_type, False))
+    if exporter_class is None:
+        raise ValueError("Invalid export format provided")
+    return exporter_class
+
+
+register_exporter("json")(JsonExporter)
+register_exporter("binary")(BinaryExporter)
+register_exporter("json", streaming=True)(NdjsonStreamExporter)
+register_exporter("binary", streaming=True)(FramedBinaryStreamExporter)
+register_exporter("columnar")(ColumnarExporter)
+
+
 # This will be our factory method
-def ExportFactory(format_type=Union[Literal["binary"], Literal["json"]]) -> Exporter:
-    if format_type == "binary":
-        return BinaryExporter()
-    if format_type == "json":
-        return JsonExporter()
+def ExportFactory(
+    format_type=Union[Literal["binary"], Literal["json"], Literal["columnar"]],
+    streaming: bool = False,
+    compress: bool = False,
+) -> Exporter:
+    key = (format_type, streaming, compress)
+    exporter = _instances.get(key)
+    if exporter is not None:
+        return exporter
+
+    exporter_class = _find_exporter(format_type, streaming)
+    if issubclass(exporter_class, StreamExporter):
+        exporter = exporter_class(compress)
+    elif compress:
+        raise ValueError("This export format does not support compression")
+    else:
+        exporter = exporter_class()
+
+    _instances[key] = exporter
+    return exporter
+
+
+def _export_shard(format_type: str, compress: bool, shard: list) -> bytes:
+    exporter = ExportFactory(format_type=format_type, streaming=True, compress=compress)
+    return exporter.export(shard)
 
-    raise ValueError("Invalid export format provided")
+
+class ParallelExporter:
+    """Splits the records in shards of `shard_size` records, serializes the shards
+    on a process pool with the exporter chosen by ExportFactory, and writes them in
+    order to a single output. Only the streaming formats are used, because their
+    shards can simply be concatenated. At most `max_in_flight` shards are in memory
+    at the same time"""
+
+    def __init__(
+        self,
+        format_type: str,
+        compress: bool = False,
+        shard_size: int = 50_000,
+        workers: int = None,
+        max_in_flight: int = None,
+    ) -> None:
+        # fails early if the format does not exist or can not be compressed
+        ExportFactory(format_type=format_type, streaming=True, compress=compress)
+        self.format_type = format_type
+        self.compress = compress
+        self.shard_size = shard_size
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+
+    def export_to(self, records: Iterable[dict], output: BinaryIO) -> int:
+        from concurrent.futures import ProcessPoolExecutor
+
+        records = iter(records)
+        written = 0
+        workers = self.workers or os.cpu_count() or 1
+        max_in_flight = self.max_in_flight or workers * 2
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            in_flight: Deque = deque()
+            while True:
+                shard = list(islice(records, self.shard_size))
+                if shard:
+                    in_flight.append(
+                        executor.submit(
+                            _export_shard, self.format_type, self.compress, shard
+                        )
+                    )
+                    written += len(shard)
+                # the oldest shard is written first, keeping the records in order
+                if in_flight and (not shard or len(in_flight) >= max_in_flight):
+                    output.write(in_flight.popleft().result())
+                if not shard and not in_flight:
+                    return written
 
 
 if __name__ == "__main__":
@@ -46,8 +527,44 @@ if __name__ == "__main__":
     json_exporter = ExportFactory(format_type="json")
     binary_exporter = ExportFactory(format_type="binary")
 
+    # the instances are cached by the factory
+    assert ExportFactory(format_type="json") is json_exporter
+
     json_data = json_exporter.export(my_data)
     binary_data = binary_exporter.export(my_data)
 
     print(f"Type: {type(json_data)}. Output: {json_data}")
     print(f"Type: {type(binary_data)}. Output: {binary_data}")
+
+    # the streaming exporters accept any iterable, the records are generated,
+    # written and forgotten one by one
+    many_records = ({"id": index, "name": f"book {index}"} for index in range(100_000))
+    stream_exporter = ExportFactory(format_type="json", streaming=True, compress=True)
+    output = io.BytesIO()
+    written = stream_exporter.export_to(many_records, output)
+    print(f"Streamed {written} records in {output.tell()} compressed bytes")
+
+    output.seek(0)
+    assert sum(1 for _ in stream_exporter.load_from(output)) == written
+
+    # the columnar format is compact and is read back without per object parsing
+    table = [
+        {"id": index, "price": index * 0.5, "on_sale": index % 2 == 0, "name": f"b{index}"}
+        for index in range(100_000)
+    ]
+    columnar_data = ExportFactory(format_type="columnar").export(table)
+    reader = ColumnarReader(columnar_data)
+    prices = next(reader.batches())["price"]
+    print(f"Columnar: {len(columnar_data)} bytes, price sum {sum(prices)}")
+    assert list(reader.rows()) == table
+
+    framed_exporter = ExportFactory(format_type="binary", streaming=True)
+    framed_data = io.BytesIO(framed_exporter.export(my_data))
+    assert list(framed_exporter.load_from(framed_data)) == my_data
+
+    # the shards are serialized on all the cores and written in order
+    parallel_output = io.BytesIO()
+    ParallelExporter("json", shard_size=10_000).export_to(iter(table), parallel_output)
+    parallel_output.seek(0)
+    assert list(NdjsonStreamExporter().load_from(parallel_output)) == table
+    print(f"Parallel export: {parallel_output.tell()} bytes")
@@ -2,12 +2,39 @@
 # create a composite pipeline system
 
 from __future__ import annotations
+import hashlib
+import json
+import pickle
+import queue
+import threading
+import time
+import tracemalloc
 from abc import ABC, ABCMeta, abstractmethod
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 
 class Component(ABC):
-    def add(self, component: Component):
+    def add(self, component: Component, depends_on: Iterable[Component] = ()):
         pass
 
     def remove(self, component: Component):
@@ -17,25 +44,87 @@ class Component(ABC):
     def execute(self):
         pass
 
+    # streaming mode: receives an iterator of batches (lists of items) and lazily
+    # yields the transformed batches
+    def stream(self, batches: Iterable[list]) -> Iterator[list]:
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support the streaming mode"
+        )
+
     def is_composite(self) -> bool:
         return False
 
 
 class Composite(Component):
     _childrens: List[Component]
+    # the siblings each child must wait for when the pipeline runs on a DAGExecutor
+    _dependencies: Dict[int, List[Component]]
+    # the composites containing this one, told when the tree changes
+    _parents: List[Composite]
+    _compiled: Optional[CompiledPipeline]
 
-    def __init__(self) -> None:
+    # in streaming mode, `buffer_size` bounds how many batches can wait between
+    # two children. Each buffered child then runs on its own thread
+    def __init__(self, buffer_size: Optional[int] = None) -> None:
         self._childrens = []
+        self._dependencies = {}
+        self._parents = []
+        self._compiled = None
+        self.buffer_size = buffer_size
+
+    def add(self, component: Component, depends_on: Iterable[Component] = ()):
+        depends_on = list(depends_on)
+        for dependency in depends_on:
+            if dependency not in self._childrens:
+                raise ValueError("A component can only depend on a previous sibling")
 
-    def add(self, component: Component):
         self._childrens.append(component)
+        if depends_on:
+            self._dependencies[id(component)] = depends_on
+        if component.is_composite():
+            component._parents.append(self)
+        self._invalidate()
 
     def remove(self, component: Component):
         self._childrens.remove(component)
+        self._dependencies.pop(id(component), None)
+        for dependencies in self._dependencies.values():
+            while component in dependencies:
+                dependencies.remove(component)
+        if component.is_composite():
+            component._parents.remove(self)
+        self._invalidate()
+
+    def _invalidate(self):
+        self._compiled = None
+        for parent in self._parents:
+            parent._invalidate()
+
+    # flattens the tree once, the plan is reused until the tree changes
+    def compile(self) -> CompiledPipeline:
+        if self._compiled is None:
+            self._compiled = CompiledPipeline(self)
+        return self._compiled
+
+    def dependencies(self, component: Component) -> List[Component]:
+        return self._dependencies.get(id(component), [])
+
+    @property
+    def childrens(self) -> List[Component]:
+        return list(self._childrens)
 
     def execute(self):
+        self.compile().run()
+
+    def stream(self, batches: Iterable[list]) -> Iterator[list]:
+        if self.buffer_size is None:
+            return self.compile().stream(batches)
+
         for child in self._childrens:
-            child.execute()
+            batches = child.stream(batches)
+            if self.buffer_size is not None:
+                batches = buffered(batches, self.buffer_size)
+        return iter(batches)
 
     def is_composite(self) -> bool:
         return True
@@ -46,16 +135,36 @@ class Leaf(Component, metaclass=ABCMeta):
     def execute(self):
         pass
 
+    # the leaves only need to implement `transform` (or `transform_batch`) to
+    # take part in a stream, by default the items pass through unchanged
+    def transform(self, item: Any) -> Any:
+        return item
+
+    def transform_batch(self, batch: list) -> list:
+        transform = self.transform
+        return [transform(item) for item in batch]
+
+    def stream(self, batches: Iterable[list]) -> Iterator[list]:
+        for batch in batches:
+            yield self.transform_batch(batch)
+
 
 class NormalizeStage(Leaf):
     def execute(self):
         print("Normalizing input data")
 
+    def transform(self, item: Any) -> Any:
+        return item.strip().lower() if isinstance(item, str) else item
+
 
 class OptmizeStage(Leaf):
     def execute(self):
         print("Optmizing the input data")
 
+    # drops the empty items
+    def transform_batch(self, batch: list) -> list:
+        return [item for item in batch if item]
+
 
 class ExecuteInputStage(Leaf):
     def execute(self):
@@ -67,18 +176,507 @@ class GenerateOutputStage(Leaf):
         print("Generating output data")
 
 
+def fingerprint(batch: list) -> bytes:
+    data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# a decorator for leaves that caches the output of `transform_batch` by a
+# fingerprint of the input batch. When a pipeline runs again with partly changed
+# data, only the batches that changed (and what they change downstream) are
+# recomputed. At most `max_entries` outputs are kept, least recently used first out.
+# The cached items are shared with the next stages, so they must be immutable (or
+# never changed in place, like the strings and tuples of most pipelines)
+class MemoizedStage(Leaf):
+    stage: Leaf
+    hits: int
+    misses: int
+
+    def __init__(
+        self,
+        stage: Leaf,
+        max_entries: int = 1024,
+        key: Callable[[list], Any] = fingerprint,
+    ) -> None:
+        self.stage = stage
+        self.max_entries = max_entries
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict = OrderedDict()
+
+    def execute(self):
+        self.stage.execute()
+
+    def transform(self, item: Any) -> Any:
+        return self.stage.transform(item)
+
+    def transform_batch(self, batch: list) -> list:
+        key = self.key(batch)
+        output = self._cache.get(key)
+        if output is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            # a new list, so the next stages can not add or remove cached items
+            return list(output)
+
+        self.misses += 1
+        output = self.stage.transform_batch(batch)
+        self._cache[key] = list(output)
+        if len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        return output
+
+    def clear(self):
+        self._cache.clear()
+
+
+# a composite overriding `execute` (or `stream`) does more than running its
+# children, so the plans and executors must call it instead of descending into it
+def _custom_execute(composite: Component) -> bool:
+    return type(composite).execute is not Composite.execute
+
+
+def _custom_stream(composite: Component) -> bool:
+    return type(composite).stream is not Composite.stream
+
+
+# a composite tree flattened in a linear plan: the `execute` of every leaf in
+# order, and for streaming, the consecutive `transform_batch` of the leaves fused
+# in a single step. Leaves with their own `stream` and buffered composites are
+# kept as they are
+class CompiledPipeline:
+    _executes: List[Callable[[], Any]]
+    _segments: List[Union[List[Callable[[list], list]], Component]]
+
+    def __init__(self, composite: Composite) -> None:
+        self._executes = []
+        self._segments = []
+        self._visit(composite)
+
+    def __len__(self) -> int:
+        return len(self._executes)
+
+    def _fused(self) -> List[Callable[[list], list]]:
+        if not self._segments or not isinstance(self._segments[-1], list):
+            self._segments.append([])
+        return self._segments[-1]
+
+    # nested composites that override `execute` (or `stream`, or are buffered)
+    # are kept as a single opaque step for that mode, the others are flattened
+    def _visit(
+        self, composite: Composite, executes: bool = True, segments: bool = True
+    ):
+        for child in composite.childrens:
+            if not child.is_composite():
+                if executes:
+                    self._executes.append(child.execute)
+                if not segments:
+                    continue
+                if type(child).stream is Leaf.stream:
+                    self._fused().append(child.transform_batch)
+                else:
+                    self._segments.append(child)
+                continue
+
+            custom_execute = _custom_execute(child)
+            custom_stream = _custom_stream(child) or child.buffer_size is not None
+            if executes and custom_execute:
+                self._executes.append(child.execute)
+            if segments and custom_stream:
+                self._segments.append(child)
+
+            inner_executes = executes and not custom_execute
+            inner_segments = segments and not custom_stream
+            if inner_executes or inner_segments:
+                self._visit(child, inner_executes, inner_segments)
+
+    def run(self):
+        for execute in self._executes:
+            execute()
+
+    def stream(self, batches: Iterable[list]) -> Iterator[list]:
+        for segment in self._segments:
+            if isinstance(segment, list):
+                batches = _apply_transforms(batches, tuple(segment))
+            else:
+                batches = segment.stream(batches)
+        return iter(batches)
+
+
+def _apply_transforms(
+    batches: Iterable[list], transforms: Tuple[Callable[[list], list], ...]
+) -> Iterator[list]:
+    for batch in batches:
+        for transform in transforms:
+            batch = transform(batch)
+        yield batch
+
+
+class StageStats:
+    __slots__ = ("wall", "cpu", "calls", "allocated", "items")
+
+    def __init__(self) -> None:
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.allocated = 0
+        self.items = 0
+
+
+# measures every leaf of a composite tree: wall time, cpu time, calls, allocated
+# bytes (with `track_allocations`, it uses tracemalloc and slows things down) and
+# items produced in streaming mode. The pipeline is only instrumented when it runs
+# through the profiler, so there is no cost at all when it is not used.
+# Buffered composites are profiled without their buffers, in a single thread.
+# Composites overriding `execute` (or `stream`) are measured as a single stage
+class Profiler:
+    _stats: Dict[Tuple[str, ...], StageStats]
+
+    def __init__(self, track_allocations: bool = False) -> None:
+        self.track_allocations = track_allocations
+        self._stats = {}
+        self._nested: List[list] = []
+        # the profiled pipelines and the name of their root
+        self._roots: List[Tuple[Component, str]] = []
+
+    @staticmethod
+    def _name(component: Component, index: int) -> str:
+        return f"{component.__class__.__name__}[{index}]"
+
+    # each pipeline is a separate root, named by the caller or numbered in the
+    # order they were first profiled
+    def _root(self, component: Component, name: Optional[str]) -> Tuple[str, ...]:
+        for profiled, root_name in self._roots:
+            if profiled is component and (name is None or name == root_name):
+                return (root_name,)
+        if name is None:
+            name = self._name(component, len(self._roots))
+        self._roots.append((component, name))
+        return (name,)
+
+    # every measure is pushed on a stack, so the time (and memory) spent in nested
+    # measures, like the upstream stages pulled by a stream, is only counted once
+    def _start(self) -> Tuple[float, float, int]:
+        self._nested.append([0.0, 0.0, 0])
+        allocated = tracemalloc.get_traced_memory()[0] if self.track_allocations else 0
+        return time.perf_counter(), time.thread_time(), allocated
+
+    def _stop(self, path: Tuple[str, ...], start: Tuple[float, float, int], items: int = 0):
+        wall = time.perf_counter() - start[0]
+        cpu = time.thread_time() - start[1]
+        allocated = 0
+        if self.track_allocations:
+            allocated = tracemalloc.get_traced_memory()[0] - start[2]
+
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1][0] += wall
+            self._nested[-1][1] += cpu
+            self._nested[-1][2] += allocated
+
+        stats = self._stats.get(path)
+        if stats is None:
+            stats = self._stats[path] = StageStats()
+        stats.wall += wall - nested[0]
+        stats.cpu += cpu - nested[1]
+        stats.allocated += allocated - nested[2]
+        stats.calls += 1
+        stats.items += items
+
+    def _tracing(self) -> bool:
+        # returns if the tracing was started here, to stop it at the end
+        if self.track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            return True
+        return False
+
+    def run(self, component: Component, name: Optional[str] = None):
+        started = self._tracing()
+        try:
+            self._run(component, self._root(component, name))
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    def _run(self, component: Component, path: Tuple[str, ...]):
+        if component.is_composite() and not _custom_execute(component):
+            for index, child in enumerate(component.childrens):
+                self._run(child, path + (self._name(child, index),))
+            return
+
+        start = self._start()
+        component.execute()
+        self._stop(path, start)
+
+    def stream(
+        self, component: Component, batches: Iterable[list], name: Optional[str] = None
+    ) -> Iterator[list]:
+        started = self._tracing()
+        try:
+            yield from self._stream(component, batches, self._root(component, name))
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    def _stream(
+        self, component: Component, batches: Iterable[list], path: Tuple[str, ...]
+    ) -> Iterator[list]:
+        if component.is_composite() and not _custom_stream(component):
+            for index, child in enumerate(component.childrens):
+                batches = self._stream(child, batches, path + (self._name(child, index),))
+            return iter(batches)
+        return self._timed(component.stream(batches), path)
+
+    def _timed(self, batches: Iterator[list], path: Tuple[str, ...]) -> Iterator[list]:
+        while True:
+            start = self._start()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                self._stop(path, start)
+                return
+            self._stop(path, start, len(batch))
+            yield batch
+
+    def report(self) -> dict:
+        root: dict = {}
+        for path, stats in self._stats.items():
+            node = root
+            for name in path:
+                node = node.setdefault("children", {}).setdefault(name, {"name": name})
+            node.update(
+                wall=stats.wall,
+                cpu=stats.cpu,
+                calls=stats.calls,
+                allocated=stats.allocated,
+                items=stats.items,
+            )
+
+        # the composites are the sum of their children
+        def aggregate(node: dict) -> dict:
+            # a composite without measured leaves has no metrics
+            for metric in ("wall", "cpu", "calls", "allocated", "items"):
+                node.setdefault(metric, 0)
+            children = [aggregate(child) for child in node.pop("children", {}).values()]
+            if children:
+                node["children"] = children
+                for metric in ("wall", "cpu", "allocated"):
+                    node[metric] = sum(child[metric] for child in children)
+                node["calls"] = children[0]["calls"]
+                node["items"] = children[-1]["items"]
+            node["items_per_second"] = node["items"] / node["wall"] if node["wall"] else 0.0
+            return node
+
+        # with many profiled pipelines, they are grouped in a single root
+        roots = list(root.get("children", {}).values())
+        if len(roots) == 1:
+            return aggregate(roots[0])
+        return aggregate({"name": "pipelines", "children": root.get("children", {})})
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    # the "collapsed stacks" format of flame graph tools, in microseconds
+    def to_collapsed(self) -> str:
+        return "\n".join(
+            f"{';'.join(path)} {int(stats.wall * 1_000_000)}"
+            for path, stats in self._stats.items()
+        )
+
+
+# groups the items in lists of `size` items
+def chunked(items: Iterable[Any], size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# marks the end of a buffered stream, carrying the error of the producer if any
+class _EndOfStream:
+    def __init__(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+
+
+# runs `batches` on a thread, keeping at most `maxsize` batches ahead of the
+# consumer. Errors of the producer are raised on the consumer side
+def buffered(batches: Iterable[list], maxsize: int) -> Iterator[list]:
+    buffer: queue.Queue = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+        except BaseException as error:
+            put(_EndOfStream(error))
+            return
+        put(_EndOfStream())
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, _EndOfStream):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+    finally:
+        # the consumer may stop early, the producer thread must not block forever
+        stopped.set()
+
+
+# streams `items` through a component in batches of `batch_size`, memory usage
+# depends on the batch and buffer sizes only, not on the number of items
+def run_stream(
+    component: Component, items: Iterable[Any], batch_size: int = 1024
+) -> Iterator[Any]:
+    for batch in component.stream(chunked(items, batch_size)):
+        yield from batch
+
+
+# runs a composite tree as a DAG of leaves. The declared dependencies of a child
+# apply to all the leaves inside it, and the leaves that do not depend on each
+# other run concurrently on a thread pool (or a process pool, if the leaves are
+# picklable and CPU bound). Children without dependencies are independent.
+# Composites that override `execute` run as a single task
+class DAGExecutor:
+    def __init__(self, max_workers: int = None, use_processes: bool = False) -> None:
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+
+    # flattens the tree in a list of (task, indexes of the tasks it waits for)
+    @staticmethod
+    def plan(component: Component) -> List[Tuple[Component, Set[int]]]:
+        tasks: List[Tuple[Component, Set[int]]] = []
+
+        def visit(node: Component, inherited: Set[int]) -> Set[int]:
+            if not node.is_composite() or _custom_execute(node):
+                tasks.append((node, inherited))
+                return {len(tasks) - 1}
+
+            leaves_of: Dict[int, Set[int]] = {}
+            all_leaves: Set[int] = set()
+            for child in node.childrens:
+                waits_for = set(inherited)
+                for dependency in node.dependencies(child):
+                    waits_for |= leaves_of[id(dependency)]
+                leaves_of[id(child)] = visit(child, waits_for)
+                all_leaves |= leaves_of[id(child)]
+            return all_leaves
+
+        visit(component, set())
+        return tasks
+
+    def _create_executor(self) -> Executor:
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def run(self, component: Component):
+        tasks = self.plan(component)
+        waiting = {index: set(waits_for) for index, (_, waits_for) in enumerate(tasks)}
+        dependents: Dict[int, List[int]] = {index: [] for index in waiting}
+        for index, waits_for in waiting.items():
+            for dependency in waits_for:
+                dependents[dependency].append(index)
+
+        with self._create_executor() as executor:
+            running: Dict[Future, int] = {}
+
+            def submit_ready():
+                for index in [index for index, waits_for in waiting.items() if not waits_for]:
+                    del waiting[index]
+                    running[executor.submit(tasks[index][0].execute)] = index
+
+            submit_ready()
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = running.pop(future)
+                    # stop scheduling on the first error, the running leaves finish
+                    if future.exception() is not None:
+                        wait(running)
+                        raise future.exception()
+                    for dependent in dependents[index]:
+                        waiting[dependent].discard(index)
+                submit_ready()
+
+
 if __name__ == "__main__":
     pre_pipeline = Composite()
     pre_pipeline.add(NormalizeStage())
     pre_pipeline.add(OptmizeStage())
 
     post_pipeline = Composite()
-    post_pipeline.add(ExecuteInputStage())
-    post_pipeline.add(GenerateOutputStage())
+    execute_stage = ExecuteInputStage()
+    post_pipeline.add(execute_stage)
+    post_pipeline.add(GenerateOutputStage(), depends_on=[execute_stage])
 
     general_pipeline = Composite()
     general_pipeline.add(pre_pipeline)
-    general_pipeline.add(post_pipeline)
+    general_pipeline.add(post_pipeline, depends_on=[pre_pipeline])
 
     # execute the pipeline
     general_pipeline.execute()
+
+    # the same pipeline, normalize and optimize run at the same time
+    DAGExecutor(max_workers=4).run(general_pipeline)
+
+    # the tree is compiled once, changing it invalidates the plan
+    plan = general_pipeline.compile()
+    assert general_pipeline.compile() is plan
+    pre_pipeline.remove(pre_pipeline.childrens[-1])
+    assert general_pipeline.compile() is not plan
+    print(f"Compiled plan with {len(general_pipeline.compile())} stages")
+
+    # memoized stages only recompute the batches that changed since the last run
+    memoized_normalize = MemoizedStage(NormalizeStage())
+    memoized_optimize = MemoizedStage(OptmizeStage())
+    memoized_pipeline = Composite()
+    memoized_pipeline.add(memoized_normalize)
+    memoized_pipeline.add(memoized_optimize)
+
+    dataset = [f"  Item {index}  " for index in range(10_000)]
+    list(run_stream(memoized_pipeline, dataset, batch_size=100))
+    dataset[5_000] = "  Changed item  "
+    second_run = list(run_stream(memoized_pipeline, dataset, batch_size=100))
+    assert second_run[5_000] == "changed item"
+    print(f"Second run reused {memoized_normalize.hits} of 100 batches")
+
+    # find the slow stages
+    profiler = Profiler(track_allocations=True)
+    profiler.run(general_pipeline)
+    print(profiler.to_collapsed())
+
+    streaming_profiler = Profiler()
+    for _ in streaming_profiler.stream(memoized_pipeline, chunked(dataset, 100)):
+        pass
+    print(streaming_profiler.to_json())
+
+    # streaming mode: the items flow lazily through the stages in small batches
+    streaming_pipeline = Composite(buffer_size=4)
+    streaming_pipeline.add(NormalizeStage())
+    streaming_pipeline.add(OptmizeStage())
+    streaming_pipeline.add(ExecuteInputStage())
+    streaming_pipeline.add(GenerateOutputStage())
+
+    raw_items = (f"  Item {index}  " if index % 10 else "" for index in range(1_000_000))
+    processed = sum(1 for _ in run_stream(streaming_pipeline, raw_items, batch_size=512))
+    print(f"Streamed {processed} items")
@@ -1,34 +1,284 @@
-from typing import Dict
+import operator
+import sys
+import weakref
+from array import array
+from itertools import compress, repeat
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+# the key of a flyweight: the order of the state items does not matter
+CarKey = FrozenSet[str]
 
 
 class CarFlyweight:
-    def __init__(self, state: list) -> None:
-        self._state = state
+    # no __dict__ per instance and the state can not be changed after creation,
+    # so the same flyweight can be safely shared by every car
+    __slots__ = ("_state", "__weakref__")
+
+    _state: Tuple[str, ...]
+
+    def __init__(self, state: Iterable[str]) -> None:
+        object.__setattr__(self, "_state", tuple(sys.intern(item) for item in state))
+
+    def __setattr__(self, name: str, value) -> None:
+        raise AttributeError("CarFlyweight is immutable")
+
+    @property
+    def state(self) -> Tuple[str, ...]:
+        return self._state
+
+    def __repr__(self) -> str:
+        return f"CarFlyweight({list(self._state)})"
 
 
 class CarFactory:
-    _cars: Dict[str, CarFlyweight] = {}
+    _pool: Dict[CarKey, CarFlyweight]
+    _lookups: int
+    _hits: int
 
-    def __init__(self, initial_state: list) -> None:
+    # each factory owns its pool, unless a pool is given to share it explicitly
+    def __init__(
+        self,
+        initial_state: Iterable[Iterable[str]] = (),
+        pool: Optional[Dict[CarKey, CarFlyweight]] = None,
+    ) -> None:
+        self._pool = pool if pool is not None else self._new_pool()
+        self._lookups = 0
+        self._hits = 0
         for state in initial_state:
-            self._cars[self._get_hash(state)] = CarFlyweight(state)
+            state = tuple(state)
+            # a repeated state keeps its first flyweight
+            if self.make_key(state) not in self._pool:
+                self._create(state)
+
+    def _new_pool(self) -> Dict[CarKey, CarFlyweight]:
+        return {}
+
+    @staticmethod
+    def make_key(state: Iterable[str]) -> CarKey:
+        if isinstance(state, frozenset):
+            return state
+        return frozenset(sys.intern(item) for item in state)
+
+    def _create(self, state: Iterable[str]) -> CarFlyweight:
+        flyweight = CarFlyweight(state)
+        self._pool[self.make_key(flyweight.state)] = flyweight
+        return flyweight
+
+    # a prebuilt key (see make_key) is used as is, so a hit does not allocate
+    def __getitem__(self, state: Iterable[str]) -> CarFlyweight:
+        self._lookups += 1
+        key = state if isinstance(state, frozenset) else self.make_key(state)
+        flyweight = self._pool.get(key)
+        if flyweight is None:
+            return self._create(state)
+
+        self._hits += 1
+        return flyweight
 
-    def _get_hash(self, state: list) -> str:
-        return ".".join(sorted(state))
+    def get_many(self, states: Iterable[Iterable[str]]) -> List[CarFlyweight]:
+        return [self[state] for state in states]
 
-    def __getitem__(self, state: list) -> CarFlyweight:
-        car_hash = self._get_hash(state)
+    def __len__(self) -> int:
+        return len(self._pool)
 
-        if not self._cars.get(car_hash, None):
-            print("Creating new flyweight")
-            self._cars[car_hash] = CarFlyweight(state)
-            return self._cars[car_hash]
+    # approximate bytes saved by sharing the flyweights instead of creating
+    # one object (and its state) for every lookup
+    def memory_saved(self) -> int:
+        if not self._pool:
+            return 0
 
-        print("Return existing flyweight")
-        return self._cars[car_hash]
+        flyweight_size = sum(
+            sys.getsizeof(flyweight) + sys.getsizeof(flyweight.state)
+            for flyweight in self._pool.values()
+        ) / len(self._pool)
+        return int(max(self._lookups - len(self._pool), 0) * flyweight_size)
+
+    def stats(self) -> dict:
+        return {"size": len(self._pool), "lookups": self._lookups, "hits": self._hits}
 
     def __str__(self) -> str:
-        print("Cars: " + ", ".join(self._cars.keys))
+        return "Cars: " + ", ".join(
+            ".".join(sorted(flyweight.state)) for flyweight in self._pool.values()
+        )
+
+
+# the pool only keeps weak references, so a flyweight that is no longer used
+# by any car is reclaimed and the pool follows the live working set.
+# Note that flyweights created from `initial_state` are reclaimed right away
+# unless something else keeps a reference to them
+class WeakCarFactory(CarFactory):
+    _reclaimed: int
+
+    def __init__(
+        self,
+        initial_state: Iterable[Iterable[str]] = (),
+        pool: Optional[weakref.WeakValueDictionary] = None,
+    ) -> None:
+        self._reclaimed = 0
+        super().__init__(initial_state, pool)
+
+    def _new_pool(self) -> weakref.WeakValueDictionary:
+        return weakref.WeakValueDictionary()
+
+    # each flyweight created by this factory counts once when it is collected,
+    # the pool may be shared with other factories
+    def _create(self, state: Iterable[str]) -> CarFlyweight:
+        flyweight = super()._create(state)
+        finalizer = weakref.finalize(flyweight, self._count_reclaimed, weakref.ref(self))
+        finalizer.atexit = False
+        return flyweight
+
+    # holds the factory weakly, the finalizers must not keep it alive
+    @staticmethod
+    def _count_reclaimed(factory_reference: weakref.ref) -> None:
+        factory = factory_reference()
+        if factory is not None:
+            factory._reclaimed += 1
+
+    @property
+    def reclaimed(self) -> int:
+        return self._reclaimed
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["reclaimed"] = self.reclaimed
+        return stats
+
+
+# the extrinsic state of every car (position, owner and speed) stored in columns.
+# Instead of one python object per car, each column is a typed array and each
+# car is just a row number. The intrinsic state is a small integer pointing to
+# a flyweight of the factory
+class CarFleet:
+    factory: CarFactory
+    _models: List[CarFlyweight]
+    _model_ids: Dict[CarKey, int]
+
+    def __init__(self, factory: CarFactory) -> None:
+        self.factory = factory
+        self._models = []
+        self._model_ids = {}
+        self.model = array("I")
+        self.x = array("d")
+        self.y = array("d")
+        self.owner = array("Q")
+        self.speed = array("d")
+
+    def __len__(self) -> int:
+        return len(self.model)
+
+    def model_id(self, state: Iterable[str]) -> int:
+        key = self.factory.make_key(state)
+        model_id = self._model_ids.get(key)
+        if model_id is None:
+            # the fleet keeps the flyweight alive, even with a weak factory pool
+            model_id = len(self._models)
+            self._models.append(self.factory[key])
+            self._model_ids[key] = model_id
+        return model_id
+
+    def add(
+        self, state: Iterable[str], position: Tuple[float, float], owner: int, speed: float
+    ) -> int:
+        # the values are converted before any column changes, a bad one
+        # leaves the fleet untouched
+        self._extend(
+            array("I", [self.model_id(state)]),
+            array("d", [position[0]]),
+            array("d", [position[1]]),
+            array("Q", [owner]),
+            array("d", [speed]),
+        )
+        return len(self.model) - 1
+
+    def add_many(
+        self,
+        state: Iterable[str],
+        positions: Iterable[Tuple[float, float]],
+        owners: Iterable[int],
+        speeds: Iterable[float],
+    ) -> None:
+        # the new columns are built and checked first, so a bad input leaves
+        # the fleet untouched
+        model_id = self.model_id(state)
+        xs = array("d")
+        ys = array("d")
+        for x, y in positions:
+            xs.append(x)
+            ys.append(y)
+        new_owners = array("Q", owners)
+        new_speeds = array("d", speeds)
+        if not len(xs) == len(new_owners) == len(new_speeds):
+            raise ValueError("All the columns must have the same size")
+
+        self._extend(array("I", [model_id]) * len(xs), xs, ys, new_owners, new_speeds)
+
+    def _extend(
+        self, models: array, xs: array, ys: array, owners: array, speeds: array
+    ) -> None:
+        self.model.extend(models)
+        self.x.extend(xs)
+        self.y.extend(ys)
+        self.owner.extend(owners)
+        self.speed.extend(speeds)
+
+    def flyweight(self, index: int) -> CarFlyweight:
+        return self._models[self.model[index]]
+
+    def __getitem__(self, index: int) -> dict:
+        return {
+            "car": self.flyweight(index),
+            "position": (self.x[index], self.y[index]),
+            "owner": self.owner[index],
+            "speed": self.speed[index],
+        }
+
+    # indexes of the cars matching all the given filters. The comparisons run
+    # over whole columns with map/compress, only `predicate` is called per row
+    def where(
+        self,
+        state: Optional[Iterable[str]] = None,
+        owner: Optional[int] = None,
+        predicate: Optional[Callable[[float], bool]] = None,
+        column: str = "speed",
+    ) -> array:
+        masks = []
+        if state is not None:
+            model_id = self._model_ids.get(self.factory.make_key(state))
+            masks.append(map(operator.eq, self.model, repeat(model_id)))
+        if owner is not None:
+            masks.append(map(operator.eq, self.owner, repeat(owner)))
+        if predicate is not None:
+            masks.append(map(predicate, getattr(self, column)))
+
+        indexes = range(len(self.model))
+        if not masks:
+            return array("Q", indexes)
+        mask = masks[0]
+        for other in masks[1:]:
+            mask = map(operator.and_, map(bool, mask), map(bool, other))
+        return array("Q", compress(indexes, mask))
+
+    # apply `function` to a whole column, or to the rows in `indexes` only
+    def update(
+        self, column: str, function: Callable[[float], float], indexes: Iterable[int] = None
+    ) -> None:
+        values = getattr(self, column)
+        if indexes is None:
+            setattr(self, column, array(values.typecode, map(function, values)))
+            return
+
+        for index in indexes:
+            values[index] = function(values[index])
+
+    # move every car along the x axis according to its speed
+    def move(self, seconds: float) -> None:
+        distances = map(operator.mul, self.speed, repeat(seconds))
+        self.x = array("d", map(operator.add, self.x, distances))
+
+    def nbytes(self) -> int:
+        columns = (self.model, self.x, self.y, self.owner, self.speed)
+        return sum(column.itemsize * len(column) for column in columns)
 
 
 if __name__ == "__main__":
@@ -40,3 +290,38 @@ if __name__ == "__main__":
 
     existing_flyweight = factory[["BMW", "Blue"]]
     new_flyweight = factory[["Focus", "Blue"]]
+    assert existing_flyweight is factory[["Blue", "BMW"]]
+
+    # bulk lookups reuse the same flyweights
+    fleet = factory.get_many([["BMW", "Blue"], ["Kwid", "Silver"]] * 50_000)
+    print(factory)
+    print(f"{len(fleet)} cars sharing {len(factory)} flyweights")
+    print(f"Memory saved: {factory.memory_saved()} bytes")
+
+    # two factories can share the same pool explicitly
+    shared_pool = {}
+    first_factory = CarFactory(pool=shared_pool)
+    second_factory = CarFactory(pool=shared_pool)
+    assert first_factory[["Kwid", "Red"]] is second_factory[["Kwid", "Red"]]
+
+    # unused flyweights disappear from a weak pool
+    weak_factory = WeakCarFactory()
+    parked_cars = weak_factory.get_many([["BMW", "Blue"], ["Focus", "Red"]] * 10)
+    del parked_cars
+    print(f"Weak pool stats: {weak_factory.stats()}")
+
+    # millions of cars as rows of a few typed arrays
+    fleet_store = CarFleet(factory)
+    fleet_store.add_many(
+        ["BMW", "Blue"],
+        ((float(i), 0.0) for i in range(100_000)),
+        range(100_000),
+        (float(i % 120) for i in range(100_000)),
+    )
+    fleet_store.add(["Kwid", "Silver"], (0.0, 1.0), owner=42, speed=80.0)
+    fleet_store.move(seconds=1.0)
+    fast_cars = fleet_store.where(predicate=lambda speed: speed > 100)
+    fleet_store.update("speed", lambda speed: speed * 0.9, fast_cars)
+    print(f"{len(fleet_store)} cars, {len(fast_cars)} slowed down")
+    print(f"Extrinsic state size: {fleet_store.nbytes()} bytes")
+    print(fleet_store[len(fleet_store) - 1])
@@ -1,8 +1,16 @@
 # proxy example
 # In this example, we will use the proxy design pattern to
 # create a retrieve service
+import asyncio
 import base64
-from typing import Dict
+import os
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # the service interface
 class BaseService:
@@ -16,30 +24,465 @@ class BaseService:
 # we do not have access to the code, this class is just an api for the external service
 # normally, the retrieve proccess can take a long time
 class ExternalService(BaseService):
-    def retrieve(self, query: str) -> str:
+    def retrieve(self, query: str) -> bytes:
         print(f"Retrieving query: {query}")
         # lets return the base64 string of query just for example purpose
         result = base64.b64encode(query.encode("ascii"))
         return result
 
 
+# returned by the caches when a key is not stored, so a cached None is still a hit
+MISSING = object()
+
+
+# the cache interface used by the proxy, so we can plug different storages
+class BaseCache:
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError("This is a abstract class")
+
+    def set(self, key: str, value: Any) -> None:
+        raise NotImplementedError("This is a abstract class")
+
+    def clear(self) -> None:
+        raise NotImplementedError("This is a abstract class")
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+
+# a size bounded cache that evicts the least recently used entry first
+# entries can also expire after `ttl` seconds and the total size of the
+# cached values can be limited with `max_bytes`
+class LRUCache(BaseCache):
+    max_entries: Optional[int]
+    max_bytes: Optional[int]
+    ttl: Optional[float]
+    current_bytes: int
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = 1024,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        sizeof: Callable[[Any], int] = len,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self._sizeof = sizeof
+        self._clock = clock
+        # key -> (value, size, expires_at)
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and not self._is_expired(entry)
+
+    def _is_expired(self, entry: tuple) -> bool:
+        expires_at = entry[2]
+        return expires_at is not None and expires_at <= self._clock()
+
+    def _drop(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.current_bytes -= size
+
+    def get(self, key: str) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        if self._is_expired(entry):
+            self._drop(key)
+            self.evictions += 1
+            self.misses += 1
+            return MISSING
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Any) -> None:
+        size = self._sizeof(value) if self.max_bytes is not None else 0
+        # the previous value is dropped even when the new one is not cached
+        if key in self._entries:
+            self._drop(key)
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            # the value alone does not fit, caching it would flush everything else
+            return
+
+        expires_at = self._clock() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, size, expires_at)
+        self.current_bytes += size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.current_bytes > self.max_bytes)
+        ):
+            oldest_key = next(iter(self._entries))
+            self._drop(oldest_key)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["entries"] = len(self._entries)
+        stats["bytes"] = self.current_bytes
+        return stats
+
+
+# a persistent cache that stores the bytes results in an append-only file.
+# Each record is a header with the key and value sizes followed by the key and
+# the value, the index (key -> value position) is rebuilt when the file is opened
+class DiskCache(BaseCache):
+    _header = struct.Struct("<II")
+
+    path: str
+    _index: Dict[str, Tuple[int, int]]
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+        self._index = {}
+        self._file = open(path, "a+b")
+        self._load_index()
+
+    def _load_index(self) -> None:
+        file_size = os.fstat(self._file.fileno()).st_size
+        self._file.seek(0)
+        offset = 0
+        while offset + self._header.size <= file_size:
+            key_size, value_size = self._header.unpack(self._file.read(self._header.size))
+            value_start = offset + self._header.size + key_size
+            if value_start + value_size > file_size:
+                break
+
+            key = self._file.read(key_size).decode("utf-8")
+            self._index[key] = (value_start, value_size)
+            offset = value_start + value_size
+            self._file.seek(offset)
+
+        # drop a record that was only half written when the process died
+        self._file.truncate(offset)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def get(self, key: str) -> Any:
+        position = self._index.get(key)
+        if position is None:
+            self.misses += 1
+            return MISSING
+
+        self.hits += 1
+        return self._read(position)
+
+    def _read(self, position: Tuple[int, int]) -> bytes:
+        offset, size = position
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    # appends a record at the end of `file`, returns the position of the value
+    def _write_record(self, file, key: str, value: bytes) -> Tuple[int, int]:
+        encoded_key = key.encode("utf-8")
+        file.seek(0, os.SEEK_END)
+        value_start = file.tell() + self._header.size + len(encoded_key)
+        file.write(self._header.pack(len(encoded_key), len(value)))
+        file.write(encoded_key)
+        file.write(value)
+        return value_start, len(value)
+
+    def set(self, key: str, value: bytes) -> None:
+        self._index[key] = self._write_record(self._file, key, value)
+        self._file.flush()
+
+    # rewrite the file keeping only the latest value of each key. The new log is
+    # written aside and atomically replaces the old one, a crash in the middle
+    # keeps the old log intact
+    def compact(self) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory)
+        index = {}
+        try:
+            with os.fdopen(descriptor, "w+b") as compacted:
+                for key, position in self._index.items():
+                    index[key] = self._write_record(compacted, key, self._read(position))
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.replace(temporary_path, self.path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        self._file.close()
+        self._file = open(self.path, "a+b")
+        self._index = index
+
+    def clear(self) -> None:
+        self._file.seek(0)
+        self._file.truncate()
+        self._index = {}
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# a two level cache: a fast memory cache in front of a persistent one.
+# Values found only in the persistent tier are promoted to the memory tier
+class TieredCache(BaseCache):
+    memory: BaseCache
+    persistent: BaseCache
+
+    def __init__(self, memory: BaseCache, persistent: BaseCache) -> None:
+        super().__init__()
+        self.memory = memory
+        self.persistent = persistent
+
+    def get(self, key: str) -> Any:
+        value = self.memory.get(key)
+        if value is MISSING:
+            value = self.persistent.get(key)
+            if value is MISSING:
+                self.misses += 1
+                return MISSING
+            self.memory.set(key, value)
+
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        self.persistent.set(key, value)
+
+    def clear(self) -> None:
+        self.memory.clear()
+        self.persistent.clear()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["memory"] = self.memory.stats()
+        stats["persistent"] = self.persistent.stats()
+        return stats
+
+
 class CachedExternalService(BaseService):
     external_service: ExternalService
-    cached_result: Dict[str, str]
+    cache: BaseCache
 
-    def __init__(self, service: ExternalService) -> None:
+    def __init__(self, service: ExternalService, cache: BaseCache = None) -> None:
         self.external_service = service
-        self.cached_result = {}
+        self.cache = cache if cache is not None else LRUCache()
 
     def retrieve(self, query: str):
-        if query not in self.cached_result.keys():
+        result = self.cache.get(query)
+        if result is MISSING:
             print("Query not cached, executing query...")
             result = self.external_service.retrieve(query)
-            self.cached_result[query] = result
+            self.cache.set(query, result)
             return result
 
         print("Returning cached response...")
-        return self.cached_result[query]
+        return result
+
+
+# a thread safe version of the proxy. Concurrent misses for the same query are
+# coalesced (single-flight): the first thread calls the external service and
+# the others wait for its result instead of hitting the slow service again
+class ThreadSafeCachedExternalService(CachedExternalService):
+    _lock: threading.Lock
+    _in_flight: Dict[str, Future]
+
+    def __init__(self, service: ExternalService, cache: BaseCache = None) -> None:
+        super().__init__(service, cache)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def retrieve(self, query: str):
+        with self._lock:
+            result = self.cache.get(query)
+            if result is not MISSING:
+                return result
+
+            future = self._in_flight.get(query)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[query] = future
+
+        # the other callers just wait for the leader, errors are shared too
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = self.external_service.retrieve(query)
+        except BaseException as error:
+            with self._lock:
+                del self._in_flight[query]
+            future.set_exception(error)
+            raise
+
+        with self._lock:
+            self.cache.set(query, result)
+            del self._in_flight[query]
+        future.set_result(result)
+        return result
+
+
+# the async version of the service interface, so one event loop can keep many
+# lookups in flight instead of blocking a thread on each one
+class AsyncBaseService:
+    async def retrieve(self, query: str):
+        raise NotImplementedError(
+            "This is a abstract class, or the method is not implemented"
+        )
+
+    # the default bulk call just fans out to retrieve, services with a real
+    # bulk api should override it
+    async def retrieve_many(self, queries: List[str]) -> list:
+        return list(await asyncio.gather(*(self.retrieve(q) for q in queries)))
+
+
+class AsyncExternalService(AsyncBaseService):
+    def __init__(self, latency: float = 0.05) -> None:
+        self.latency = latency
+
+    async def retrieve(self, query: str) -> bytes:
+        return (await self.retrieve_many([query]))[0]
+
+    # one round trip for the whole batch
+    async def retrieve_many(self, queries: List[str]) -> list:
+        print(f"Retrieving {len(queries)} queries in one call")
+        await asyncio.sleep(self.latency)
+        return [base64.b64encode(query.encode("ascii")) for query in queries]
+
+
+# a proxy that collects the queries arriving within `batch_window` seconds and
+# sends them to the upstream service as a single bulk call. `max_concurrency`
+# limits how many bulk calls can be running at the same time
+class AsyncBatchingService(AsyncBaseService):
+    service: AsyncBaseService
+    batch_window: float
+    max_batch_size: int
+
+    def __init__(
+        self,
+        service: AsyncBaseService,
+        batch_window: float = 0.005,
+        max_batch_size: int = 256,
+        max_concurrency: int = 8,
+    ) -> None:
+        self.service = service
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+
+    async def retrieve(self, query: str):
+        # the same query inside a window shares the same future
+        future = self._pending.get(query)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._pending[query] = future
+
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        # a cancelled caller must not cancel the future shared with the others
+        return await asyncio.shield(future)
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            # keep a reference so the task is not garbage collected
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: Dict[str, asyncio.Future]) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        queries = list(batch)
+        try:
+            async with self._semaphore:
+                results = await self.service.retrieve_many(queries)
+        except asyncio.CancelledError:
+            for future in batch.values():
+                future.cancel()
+            raise
+        except BaseException as error:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+            if not isinstance(error, Exception):
+                raise
+            return
+
+        for query, result in zip(queries, results):
+            future = batch[query]
+            if not future.done():
+                future.set_result(result)
+
+        # a bulk call that returned less results must not leave callers waiting
+        if len(results) != len(queries):
+            error = RuntimeError(
+                f"Expected {len(queries)} results from the service, got {len(results)}"
+            )
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+
+
+async def run_async_example():
+    service = AsyncBatchingService(AsyncExternalService(), max_batch_size=100)
+    queries = [f"users.{index % 150}" for index in range(1000)]
+    results = await asyncio.gather(*(service.retrieve(q) for q in queries))
+    print(f"Resolved {len(results)} lookups")
 
 
 if __name__ == "__main__":
@@ -50,3 +493,43 @@ if __name__ == "__main__":
     service_proxy.retrieve("users.all")
     print("Second Try")
     service_proxy.retrieve("users.all")
+
+    # a bounded cache: only two entries fit, so the oldest one is evicted
+    bounded_proxy = CachedExternalService(
+        external_service, LRUCache(max_entries=2, ttl=60, max_bytes=1024)
+    )
+    for query in ["users.all", "games.all", "users.all", "orders.all", "games.all"]:
+        bounded_proxy.retrieve(query)
+
+    print(f"Cache stats: {bounded_proxy.cache.stats()}")
+
+    # many threads asking for the same cold query result in a single upstream call
+    safe_proxy = ThreadSafeCachedExternalService(external_service)
+    threads = [
+        threading.Thread(target=safe_proxy.retrieve, args=("games.on_sale",))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"Thread safe cache stats: {safe_proxy.cache.stats()}")
+
+    # the persistent tier survives restarts, so the second proxy starts warm
+    cache_path = os.path.join(tempfile.mkdtemp(), "proxy.cache")
+    disk_cache = DiskCache(cache_path)
+    CachedExternalService(
+        external_service, TieredCache(LRUCache(), disk_cache)
+    ).retrieve("users.all")
+    disk_cache.close()
+
+    restarted_cache = DiskCache(cache_path)
+    restarted_proxy = CachedExternalService(
+        external_service, TieredCache(LRUCache(), restarted_cache)
+    )
+    restarted_proxy.retrieve("users.all")
+    restarted_cache.close()
+
+    # thousands of lookups served by a few bulk calls on a single event loop
+    asyncio.run(run_async_example())